@@ -1,14 +1,450 @@
 from __future__ import division
-from collections import Counter
+import gzip
+import hashlib
+import io
+import itertools
+import json
 import math as calc
+import multiprocessing
+import os
+import struct
+import tempfile
 
+import numpy as np
 
-class nGram():
+CACHE_FILE = 'ngram.model'
+CACHE_MAGIC = b'NGRAMv1\n'
+CACHE_ALIGN = 64  # arrays in the cache file start on 64 byte boundaries
+HEADER_SLACK = 256  # spare bytes after the JSON header of a cache file, so load() can rewrite it in place
+KEY_BASE = 2 ** 31  # word ids are int32, so key = parent * KEY_BASE + word never collides
+CHUNK_SIZE = 2 ** 24  # characters read per chunk when streaming a corpus
+FLUSH_ROWS = 2 ** 22  # smallest number of buffered n-grams merged into a streamed model at once
+SMOOTHING = ('laplace', 'kneser-ney', 'witten-bell', 'stupid-backoff')
+STUPID_BACKOFF = 0.4  # factor applied to the score of the shorter context at each stupid backoff step
+
+
+def open_corpus(file_name):
+    """Function to open a plain text or gzip compressed corpus file for reading."""
+    if file_name.endswith('.gz'):
+        return gzip.open(file_name, 'rt')
+    return open(file_name, 'r')
+
+
+def corpus_files(file_names):
+    """Function to turn the corpus_file argument (None, a path or a list of paths) into a list of paths."""
+    if file_names is None:
+        return ["corpus.data"]
+    if isinstance(file_names, str):
+        return [file_names]
+    return list(file_names)
+
+
+def corpus_stats(file_names):
+    """Function to list the path, size and modification time of every corpus file."""
+    return [[file_name, os.path.getsize(file_name), os.path.getmtime(file_name)] for file_name in file_names]
+
+
+def corpus_hash(file_names):
+    """Function to compute the SHA-1 digest of the contents of the corpus files."""
+    digest = hashlib.sha1()
+    for file_name in file_names:
+        with open(file_name, 'rb') as corpus_file:
+            for block in iter(lambda: corpus_file.read(CHUNK_SIZE), b''):
+                digest.update(block)
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def read_header(file_name):
+    """Function to read the JSON header of a cache file, returning it with the offset of the array data (or None,
+    None if the file is missing or is not a model cache)."""
+    if not os.path.exists(file_name):
+        return None, None
+    with open(file_name, 'rb') as cache_file:
+        if cache_file.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+            return None, None
+        size, = struct.unpack('<Q', cache_file.read(8))
+        header = json.loads(cache_file.read(size).decode('utf-8'))
+    return header, aligned(len(CACHE_MAGIC) + 8 + size)
+
+
+def aligned(offset):
+    """Function to round an offset up to the next CACHE_ALIGN boundary."""
+    return -(-offset // CACHE_ALIGN) * CACHE_ALIGN
+
+
+def read_chunks(file_name, chunk_size=CHUNK_SIZE):
+    """Function to split a corpus file on spaces a chunk at a time, yielding lists of words.
+
+    A word cut by the end of a chunk is carried over to the next one, so the words are exactly those of
+    corpus.split(' ')."""
+    with open_corpus(file_name) as corpus_file:
+        carry = ''
+        while True:
+            chunk = corpus_file.read(chunk_size)
+            if not chunk:
+                break
+            words = (carry + chunk).split(' ')
+            carry = words.pop()
+            yield words
+        yield [carry]
+
+
+def count_ids(ids, vocab_size, n):
+    """Function to count the n-grams of every order up to n in an array of word ids in a single pass, returning the
+    unigram counts and dicts with the keys and counts of the higher orders.
+
+    The index of the k-gram starting at each position comes out of np.unique as its inverse, so the (k+1)-gram keys
+    are built directly from it and the next word, without searching the order-k table."""
+    keys, counts = {}, {}
+    position = ids.astype(np.int64)
+    for order in range(2, n + 1):
+        size = max(len(ids) - order + 1, 0)
+        keys[order], position, counts[order] = np.unique(position[:size] * KEY_BASE + ids[order - 1:order - 1 + size],
+                                                         return_inverse=True, return_counts=True)
+    return np.bincount(ids, minlength=vocab_size).astype(np.int64), keys, counts
+
+
+def expand_keys(keys, order):
+    """Function to expand the keys of one order (> 1) into word id tuples, following the parents down to words."""
+    if order == 2:
+        return np.column_stack((keys[2] // KEY_BASE, keys[2] % KEY_BASE))
+    return np.column_stack((expand_keys(keys, order - 1)[keys[order] // KEY_BASE], keys[order] % KEY_BASE))
+
+
+def shard_ranges(file_name, shards):
+    """Function to split a corpus file into about the given number of byte ranges that each end just after a space,
+    so that no word is cut. Gzip files can not be split and always make one range."""
+    size = os.path.getsize(file_name)
+    if file_name.endswith('.gz') or size == 0:
+        return [(0, None)]
+    bounds = [0]
+    with open(file_name, 'rb') as corpus_file:
+        for shard in range(1, shards):
+            start = max(size * shard // shards, bounds[-1])
+            corpus_file.seek(start)
+            while True:
+                block = corpus_file.read(2 ** 16)
+                if not block or b' ' in block:
+                    break
+                start += len(block)
+            if not block:
+                break
+            bounds.append(start + block.index(b' ') + 1)
+    bounds.append(None)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def intern_shard(shard):
+    """Function run in a worker process to read one byte range of a corpus file and intern its words with a
+    vocabulary of its own. Returns that vocabulary, in order of first use, and the word ids of the range."""
+    file_name, start, end = shard
+    if end is None and start == 0:
+        with open_corpus(file_name) as corpus_file:
+            text = corpus_file.read()
+    else:
+        with open(file_name, 'rb') as corpus_file:
+            corpus_file.seek(start)
+            data = corpus_file.read() if end is None else corpus_file.read(end - start)
+        text = io.TextIOWrapper(io.BytesIO(data)).read()
+    words = text.split(' ')
+    if end is not None:
+        words.pop()
+    index = {}
+    ids = np.fromiter((index.setdefault(word, len(index)) for word in words), dtype=np.int32, count=len(words))
+    return list(index), ids
+
+
+def count_shard(task):
+    """Function run in a worker process to count the n-grams of one shard once its word ids are mapped to the merged
+    vocabulary. Returns the unigram counts, the sorted keys and counts of the higher orders, and the first and last
+    n-1 word ids so that the n-grams across the shard boundaries can be counted afterwards.
+
+    The keys of order 2 are already those of the merged model. The parents of higher orders are positions in the
+    shard's own table of the order below, and since that table is a subset of the merged one, mapping them to merged
+    positions keeps every key array sorted."""
+    ids, mapping, vocab_size, n = task
+    ids = mapping[ids]
+    unigram, keys, counts = count_ids(ids, vocab_size, n)
+    return unigram, keys, counts, ids[:n - 1], ids[max(len(ids) - n + 1, 0):] if n > 1 else ids[:0]
+
+
+def merge_runs(keys, counts, positions=True):
+    """Function to merge sorted unique key arrays and their counts, adding up the counts of equal keys. Returns the
+    merged keys and counts, and for every input array the positions of its keys in the merged one (None if positions
+    is False).
+
+    np.argsort(kind='stable') is a timsort, which finds the sorted runs and only merges them."""
+    lengths = [len(run) for run in keys]
+    keys, counts = np.concatenate(keys), np.concatenate(counts)
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    first = np.ones(len(keys), dtype=bool)
+    first[1:] = keys[1:] != keys[:-1]
+    starts = np.flatnonzero(first)
+    totals = np.add.reduceat(counts[order], starts) if len(keys) else counts
+    if not positions:
+        return keys[starts], totals, None
+    positions = np.empty(len(keys), dtype=np.int64)
+    positions[order] = np.cumsum(first) - 1
+    return keys[starts], totals, np.split(positions, np.cumsum(lengths)[:-1])
+
+
+def sum_by_key(keys, counts):
+    """Function to sort keys and add up the counts of equal keys, returning the unique keys and their totals."""
+    order = np.argsort(keys, kind='stable')
+    keys, counts = keys[order], counts[order]
+    if len(keys) == 0:
+        return keys, counts
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    return keys[starts], np.add.reduceat(counts, starts)
+
+
+def merge_keys(keys, counts, new_keys, new_counts):
+    """Function to merge sorted unique keys with their counts and new sorted unique keys with theirs, adding up the
+    counts of keys found in both. Returns the merged keys and counts, and the new position of every old key (None if
+    no key was inserted)."""
+    position = np.searchsorted(keys, new_keys)
+    found = position < len(keys)
+    found[found] = keys[position[found]] == new_keys[found]
+    counts = np.array(counts, dtype=np.int64)
+    counts[position[found]] += new_counts[found]
+    insert = position[~found]
+    if len(insert) == 0:
+        return keys, counts, None
+    shift = np.arange(len(keys)) + np.cumsum(np.bincount(insert, minlength=len(keys) + 1))[:len(keys)]
+    return np.insert(keys, insert, new_keys[~found]), np.insert(counts, insert, new_counts[~found]), shift
+
+
+def write_model(file_name, header, arrays):
+    """Function to write a model file: a JSON header with the layout of the named arrays, padded with HEADER_SLACK
+    spaces or more, followed by the arrays, each 64 byte aligned. The file is written under a temporary name and then
+    renamed over file_name."""
+    layout = {}
+    offset = 0
+    for name, array in arrays:
+        layout[name] = [offset, array.dtype.str, list(array.shape)]
+        offset = aligned(offset + array.nbytes)
+    header = json.dumps(dict(header, arrays=layout)).encode('utf-8')
+    data_start = aligned(len(CACHE_MAGIC) + 8 + len(header) + HEADER_SLACK)
+    header = header.ljust(data_start - len(CACHE_MAGIC) - 8)
+    with open(file_name + '.tmp', 'wb') as model_file:
+        model_file.write(CACHE_MAGIC + struct.pack('<Q', len(header)) + header)
+        for name, array in arrays:
+            model_file.seek(data_start + layout[name][0])
+            model_file.write(array.tobytes())
+    os.replace(file_name + '.tmp', file_name)
+
+
+def rewrite_header(file_name, header, data_start):
+    """Function to replace the JSON header of a model file in place, padded with spaces up to the start of the array
+    data, which is left untouched. Returns False if the new header does not fit."""
+    text = json.dumps(header).encode('utf-8')
+    size = data_start - len(CACHE_MAGIC) - 8
+    if len(text) > size:
+        return False
+    with open(file_name, 'r+b') as model_file:
+        model_file.seek(len(CACHE_MAGIC))
+        model_file.write(struct.pack('<Q', size) + text.ljust(size))
+    return True
+
+
+def read_arrays(file_name, header, data_start):
+    """Function to open the arrays of a model file with np.memmap, given its header, as a dict by name."""
+    arrays = {}
+    for name, (offset, dtype, shape) in header['arrays'].items():
+        if np.prod(shape) == 0:
+            arrays[name] = np.zeros(shape, dtype=dtype)
+        else:
+            arrays[name] = np.memmap(file_name, dtype=dtype, mode='r', offset=data_start + offset, shape=tuple(shape))
+    return arrays
+
+
+def vocab_arrays(vocab):
+    """Function to pack a vocabulary into the UTF-8 text of all words and their character offsets."""
+    text = ''.join(vocab)
+    return [('vocab_text', np.frombuffer(text.encode('utf-8'), dtype=np.uint8)),
+            ('vocab_offsets', np.cumsum([0] + [len(word) for word in vocab], dtype=np.int64))]
+
+
+def vocab_words(arrays):
+    """Function to unpack the vocabulary written by vocab_arrays() into a list of words."""
+    text = arrays['vocab_text'].tobytes().decode('utf-8')
+    offsets = arrays['vocab_offsets'].tolist()
+    return [text[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def quantize(values, bits):
+    """Function to quantize values to at most 2**bits levels, returning the codes (uint8 or uint16) and the codebook.
+
+    The values are sorted into bins holding equal numbers of them and each bin is represented by its mean, so that
+    dense ranges of values get finer levels."""
+    levels = max(min(2 ** bits, len(values)), 1)
+    order = np.argsort(values, kind='stable')
+    bins = np.arange(len(values), dtype=np.int64) * levels // max(len(values), 1)
+    codes = np.empty(len(values), dtype=np.uint8 if bits <= 8 else np.uint16)
+    codes[order] = bins
+    sizes = np.bincount(bins, minlength=levels)
+    codebook = np.bincount(bins, weights=values[order], minlength=levels) / np.maximum(sizes, 1)
+    return codes, codebook
+
+
+class nGramIndex():
+    """Base class of the n-gram models, holding the interned vocabulary and the sorted key table of every order with
+    the lookups on them. Subclasses supply log_probabilities(rows) and probability(word, words, n)."""
+    def encode(self, words, grow=False):
+        """Method to map words to integer ids. Unknown words are interned if grow is True and mapped to -1 otherwise."""
+        index = self.word_index
+        if grow:
+            intern = index.setdefault
+            ids = np.fromiter((intern(word, len(index)) for word in words), dtype=np.int32, count=len(words))
+            self.vocab.extend(list(index)[len(self.vocab):])
+            return ids
+        return np.fromiter(map(index.get, words, itertools.repeat(-1)), dtype=np.int32, count=len(words))
+
+    def index(self, rows):
+        """Method to find the position of each row of word ids in the table of its order (-1 if it was never seen)."""
+        rows = np.asarray(rows, dtype=np.int64)
+        if rows.ndim == 1:
+            rows = rows[None, :]
+        found = rows[:, 0].copy()
+        found[found >= len(self.vocab)] = -1
+        for column in range(1, rows.shape[1]):
+            found = self.extend(found, rows[:, column], column + 1)
+        return found
+
+    def extend(self, found, words, order):
+        """Method to step from the positions of (order-1)-grams to the positions of the order-grams that continue them
+        with the given word ids (-1 where either is unseen)."""
+        keys = self.keys[order]
+        key = found * KEY_BASE + words
+        position = np.searchsorted(keys, key)
+        hit = (found >= 0) & (words >= 0) & (position < len(keys))
+        hit[hit] = keys[position[hit]] == key[hit]
+        return np.where(hit, position, -1)
+
+    def find(self, ids):
+        """Method to find the position of one n-gram given as a list of word ids in the table of its order, one table
+        search per word (-1 if it was never seen)."""
+        found = ids[0]
+        for order, word in enumerate(ids[1:], 2):
+            keys = self.keys[order]
+            key = found * KEY_BASE + word
+            found = int(keys.searchsorted(key))
+            if word < 0 or found == len(keys) or keys[found] != key:
+                return -1
+        return found
+
+    def lookup(self, table, found, default):
+        """Method to read a table at the given positions (default where a position is -1)."""
+        return np.where(found >= 0, table[found.clip(0)], default)
+
+    def backoff_probabilities(self, rows):
+        """Method to look up the smoothed log probability of the last word of each row of word ids given the words
+        before it, adding up the backoff weights of ever shorter contexts until the n-gram is found in the tables.
+        Unknown words get the weight of the empty context spread evenly over the vocabulary."""
+        rows = np.asarray(rows, dtype=np.int64)
+        n = rows.shape[1]
+        missing = calc.log(STUPID_BACKOFF) if self.smoothing == 'stupid-backoff' else 0
+        P = np.full(len(rows), np.nan)
+        weight = np.zeros(len(rows))
+        for start in range(n):
+            order = n - start
+            if order == 1:
+                context = np.zeros(len(rows), dtype=np.int64)
+                found = self.index(rows[:, -1:])
+            else:
+                context = self.index(rows[:, start:-1])
+                found = self.extend(context, rows[:, -1], order)
+            hit = np.isnan(P) & (found >= 0)
+            P[hit] = weight[hit] + self.lookup(self.logprobs[order], found[hit], 0)
+            weight += self.lookup(self.backoffs[order - 1], context, missing)
+        unknown = np.isnan(P)
+        P[unknown] = weight[unknown] - calc.log(len(self.vocab))
+        return P
+
+    def ngrams(self, order):
+        """Method to expand the table of the given order into an array of word id tuples, one row per n-gram."""
+        if order == 1:
+            return np.arange(len(self.vocab), dtype=np.int64)[:, None]
+        return expand_keys(self.keys, order)
+
+    def score_batch(self, sentences, n=1):
+        """Method to calculate the cumulative n-gram log probability of many sentences at once, returned as a NumPy
+        array. Gives the same values as sentence_probability(sentence, n, form='log') for each sentence."""
+        tokenized = list(map(str.split, map(str.lower, sentences)))
+        lengths = np.fromiter(map(len, tokenized), dtype=np.int64, count=len(tokenized))
+        ids = self.encode(list(itertools.chain.from_iterable(tokenized))).astype(np.int64)
+        sentence = np.repeat(np.arange(len(tokenized)), lengths)
+        ends = np.repeat(np.cumsum(lengths), lengths)
+        starts = np.flatnonzero(np.arange(len(ids)) + n <= ends)
+        P = self.log_probabilities(np.column_stack([ids[starts + offset] for offset in range(n)]))
+        return np.bincount(sentence[starts], weights=P, minlength=len(tokenized))
+
+    def perplexity(self, sentences, n=1):
+        """Method to calculate the perplexity of the model on held-out sentences, per n-gram scored."""
+        events = sum(max(len(sentence.split()) - n + 1, 0) for sentence in sentences)
+        return calc.exp(-self.score_batch(sentences, n).sum() / max(events, 1))
+
+    def sentence_probability(self, sentence, n=1, form='antilog'):
+        """Method to calculate cumulative n-gram Maximum Likelihood Probability of a phrase or sentence."""
+        words = sentence.lower().split()
+        P = 0
+        if n == 1:
+            for index, item in enumerate(words):
+                P += self.probability(item)
+        if n == 2:
+            for index, item in enumerate(words):
+                if index >= len(words) - 1:
+                    break
+                P += self.probability(item, item+' '+words[index+1], 2)
+        if n == 3:
+            for index, item in enumerate(words):
+                if index >= len(words) - 2:
+                    break
+                P += self.probability(item+' '+words[index+1], item+' '+words[index+1]+' '+words[index+2], 3)
+        if n == 4:
+            for index, item in enumerate(words):
+                if index >= len(words) - 3:
+                    break
+                P += self.probability(item+' '+words[index+1]+' '+words[index+2], item+' '+words[index+1]+' ' +
+                                      words[index+2]+' '+words[index+3], 4)
+        if n == 5:
+            for index, item in enumerate(words):
+                if index >= len(words) - 4:
+                    break
+                P += self.probability(item+' '+words[index+1]+' '+words[index+2]+' '+words[index+3], item+' ' +
+                                      words[index+1]+' '+words[index+2]+' '+words[index+3]+' '+words[index+4], 5)
+        if form == 'log':
+            return P
+        elif form == 'antilog':
+            return calc.pow(calc.e, P)
+
+
+class nGram(nGramIndex):
     """A program which creates n-Gram (1-5) Maximum Likelihood Probabilistic Language Model with Laplace Add-1 smoothing
-    and stores it in hash-able dictionary form.
+    and stores it in integer-encoded NumPy arrays.
     n: number of bigrams (supports up to 5)
     corpus_file: relative path to the corpus file.
-    cache: saves computed values if True
+    cache: saves computed values if True. The model is written to a binary cache file (ngram.model, or the path
+        given as cache) and later runs memory-map it instead of counting again, unless the corpus has changed.
+    smoothing: 'laplace' (add-1, the default), 'kneser-ney', 'witten-bell' or 'stupid-backoff'. The last three
+        precompute the log probability of every n-gram and the backoff weight of every context once the model is
+        built (logprobs / backoffs), so probability() and score_batch() only look them up.
+
+    stream: count the corpus a chunk at a time instead of reading it whole; corpus_file may then be a list of
+        paths and files ending in .gz are decompressed on the fly. N-grams do not cross file boundaries.
+    chunk_size: number of characters read per chunk when streaming
+    processes: count the corpus in this many worker processes, each taking a range of a corpus file that ends on a
+        space. The result is identical to the serial build. Gzip files are counted whole by one worker.
+
+    Words are interned to integer ids (vocab / word_index). Unigram counts are indexed by word id. An n-gram of
+    order k > 1 is stored as the sorted int64 key parent * KEY_BASE + word, where parent is the index of its
+    (k-1)-gram prefix in the table of order k-1, so every table is in lexicographic id-tuple order and is
+    searched with np.searchsorted. counts[k] holds the parallel counts.
+
+    export() writes a pruned copy of the model with quantized log probabilities for serving with QuantizedNGram, and
+    prune_report() compares the size and perplexity of several such copies.
 
 
 Usage:
@@ -16,20 +452,38 @@ Usage:
 >>> print(ng.sentence_probability(sentence='hold your horses', n=2, form='log'))
 >>> -18.655540764
 """
-    def __init__(self, n=1, corpus_file=None, cache=False):
+    def __init__(self, n=1, corpus_file=None, cache=False, stream=False, chunk_size=CHUNK_SIZE, processes=1,
+                 smoothing='laplace'):
         """Constructor method which loads the corpus from file and creates ngrams based on imput parameters."""
-        self.words = []
-        self.load_corpus(corpus_file)
-        self.unigram = self.bigram = self.trigram = self.quadrigram = self.pentigram = None
-        self.create_unigram(cache)
-        if n >= 2:
-            self.create_bigram(cache)
-        if n >= 3:
-            self.create_trigram(cache)
-        if n >= 4:
-            self.create_quadrigram(cache)
-        if n >= 5:
-            self.create_pentigram(cache)
+        if smoothing not in SMOOTHING:
+            raise ValueError("smoothing must be one of %s" % ', '.join(SMOOTHING))
+        self.vocab = []
+        self.word_index = {}
+        self.ids = None
+        self.tail = np.zeros(0, dtype=np.int32)
+        self.token_count = 0
+        self.keys = {}
+        self.counts = {}
+        self.smoothing = smoothing
+        self.logprobs = {}
+        self.backoffs = {}
+        self.offset_tables = {}
+        self.rankings = {}
+        self.corpus_files = corpus_files(corpus_file)
+        self.updates = []
+        self.cache_file = CACHE_FILE if cache is True else cache
+        if cache and self.load(self.cache_file, n):
+            return
+        if processes > 1:
+            self.parallel_corpus(self.corpus_files, n, processes)
+        elif stream:
+            self.stream_corpus(self.corpus_files, n, chunk_size)
+        else:
+            self.load_corpus(corpus_file)
+            self.create_ngrams(n)
+        self.create_tables()
+        if cache:
+            self.save()
         return
 
     def load_corpus(self, file_name):
@@ -37,143 +491,697 @@ Usage:
         print("Loading Corpus from data file")
         if file_name is None:
             file_name = "corpus.data"
-        corpus_file = open(file_name, 'r')
+        corpus_file = open_corpus(file_name)
         corpus = corpus_file.read()
         corpus_file.close()
         print("Processing Corpus")
-        self.words = corpus.split(' ')
-    
+        self.ids = self.encode(corpus.split(' '), grow=True)
+        self.token_count = len(self.ids)
+
+    def stream_corpus(self, file_names, n, chunk_size=CHUNK_SIZE):
+        """Method to count the n-grams of every order up to n from one or more corpus files a chunk at a time.
+
+        Only the last n-1 word ids of a chunk are kept to count the n-grams that straddle the next chunk. The n-grams
+        of new chunks are buffered and merged into the model once the buffer outgrows it, so memory grows with the
+        size of the model rather than the size of the corpus and each merge is paid for by as many new rows."""
+        print("Streaming Corpus from data files")
+        self.add_chunks([read_chunks(file_name, chunk_size) for file_name in corpus_files(file_names)], n)
+
+    def update(self, new_text):
+        """Method to add the counts of new text to the model, in memory or loaded from cache, as if the text were
+        appended to the corpus after a space. The n-grams that join it to the last words of the old data are counted
+        too. The smoothed tables are recomputed by the next query that needs them.
+
+        'text:' and the SHA-1 digest of the text are added to updates, which save() writes to the cache file, so the
+        model is not taken for one built from corpus_files alone when it is loaded again."""
+        self.add_chunks([[new_text.split(' ')]], max(self.counts))
+        self.updates.append('text:' + hashlib.sha1(new_text.encode('utf-8')).hexdigest())
+
+    def update_file(self, file_name, chunk_size=CHUNK_SIZE):
+        """Method to add the counts of a corpus file to the model a chunk at a time, as update() does for text.
+
+        'file:' and the digest of the file are added to updates rather than the file to corpus_files: the file
+        continues the last words of the model, so its counts differ from those of a build over both files, and a
+        model saved afterwards must not be loaded as one."""
+        self.add_chunks([read_chunks(file_name, chunk_size)], max(self.counts))
+        self.updates.append('file:' + corpus_hash([file_name]))
+
+    def add_chunks(self, files, n):
+        """Method to count the n-grams of every order up to n in lists of words, given per file as iterables of
+        chunks, and merge them into the model. The first file continues the last n-1 words of the model (tail), the
+        others start afresh, so no n-gram crosses from one file to the next."""
+        pending = dict((order, []) for order in range(1, n + 1))
+        pending_size = 0
+        new_ids = []
+        tail = self.tail[max(len(self.tail) - n + 1, 0):] if n > 1 else self.tail[:0]
+        for number, chunks in enumerate(files):
+            if number:
+                tail = np.zeros(0, dtype=np.int32)
+            for words in chunks:
+                ids = np.concatenate((tail, self.encode(words, grow=True)))
+                self.token_count += len(ids) - len(tail)
+                if self.ids is not None:
+                    new_ids.append(ids[len(tail):])
+                for order, rows in self.window_rows(ids, len(tail), n).items():
+                    pending[order].append(rows)
+                    pending_size += len(rows)
+                tail = ids[max(len(ids) - n + 1, 0):]
+                if pending_size >= max(sum(len(counts) for counts in self.counts.values()), FLUSH_ROWS):
+                    self.add_ngrams(dict((order, np.concatenate(rows)) for order, rows in pending.items()))
+                    pending = dict((order, []) for order in range(1, n + 1))
+                    pending_size = 0
+        self.add_ngrams(dict((order, np.concatenate(rows)) for order, rows in pending.items() if rows))
+        if self.ids is not None:
+            self.ids = np.concatenate([self.ids] + new_ids)
+        self.tail = tail
+
+    def parallel_corpus(self, file_names, n, processes):
+        """Method to count the n-grams of every order up to n from one or more corpus files in a pool of worker
+        processes, one shard (byte range) per task, and merge the counts into the model.
+
+        The workers first intern the words of their shards. The shard vocabularies are merged in corpus order, so
+        word ids come out as in a serial build, and the workers then count their shards in those ids. Every shard
+        comes back as sorted key arrays, so merging them takes one pass over the keys per order (see merge_shards)."""
+        print("Counting Corpus in %d processes" % processes)
+        shards = [(file_name, start, end) for file_name in corpus_files(file_names)
+                  for start, end in shard_ranges(file_name, processes)]
+        pool = multiprocessing.Pool(processes)
+        try:
+            interned = pool.map(intern_shard, shards, chunksize=1)
+            mappings = [self.encode(words, grow=True) for words, ids in interned]
+            tasks = [(ids, mapping, len(self.vocab), n) for (words, ids), mapping in zip(interned, mappings)]
+            del interned
+            results = pool.map(count_shard, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        self.merge_shards(shards, results, n)
+
+    def merge_shards(self, shards, results, n):
+        """Method to merge the counts of the shards of parallel_corpus(), given the results of count_shard() in
+        corpus order, into the empty model.
+
+        The n-grams across a shard boundary are those that start in the last n-1 words before it and end in the
+        first n-1 words after it. They are few, and are keyed and sorted as one more run. Order by order, the parents
+        of every shard's keys are mapped to the merged table of the order below and the sorted runs are merged."""
+        self.counts[1] = np.sum([result[0] for result in results], axis=0)
+        self.token_count += int(self.counts[1].sum())
+        rows = dict((order, []) for order in range(1, n + 1))
+        tail = np.zeros(0, dtype=np.int32)
+        for shard, (unigram, keys, counts, head, shard_tail) in zip(shards, results):
+            if shard[1] == 0:
+                tail = np.zeros(0, dtype=np.int32)
+            ids = np.concatenate((tail, head))
+            for order, order_rows in self.window_rows(ids, len(tail), n).items():
+                rows[order].append(order_rows[:min(order - 1, len(tail))])
+            if len(shard_tail) < n - 1:
+                ids = np.concatenate((tail, shard_tail))
+            else:
+                ids = shard_tail
+            tail = ids[max(len(ids) - n + 1, 0):]
+        positions = [None] * len(results)
+        for order in range(2, n + 1):
+            keys, counts = [], []
+            for position, (unigram, shard_keys, shard_counts, head, shard_tail) in zip(positions, results):
+                shard_keys = shard_keys[order]
+                if order > 2:
+                    shard_keys = position[shard_keys // KEY_BASE] * KEY_BASE + shard_keys % KEY_BASE
+                keys.append(shard_keys)
+                counts.append(shard_counts[order])
+            boundary = np.concatenate(rows[order]).astype(np.int64)
+            boundary_keys, boundary_counts = sum_by_key(self.index(boundary[:, :-1]) * KEY_BASE + boundary[:, -1],
+                                                        np.ones(len(boundary), dtype=np.int64))
+            self.keys[order], self.counts[order], positions = merge_runs(
+                keys + [boundary_keys], counts + [boundary_counts], order < n)
+        self.tail = tail
+
+    def window_rows(self, ids, start, n):
+        """Method to cut an id array into the n-grams (orders 1-n) that end at or after position start, one array of
+        word id tuples per order."""
+        rows = {}
+        for order in range(1, n + 1):
+            first = max(start - order + 1, 0)
+            size = max(len(ids) - order + 1 - first, 0)
+            rows[order] = np.column_stack([ids[first + offset:first + offset + size] for offset in range(order)])
+        return rows
+
+    def add_ngrams(self, rows, counts=None):
+        """Method to add n-grams to the model, given per order as arrays of word id tuples and their counts (1 each if
+        counts is None). Every (k-1)-gram prefix of a new k-gram must be in the model or added along with it. The
+        smoothed tables and the offset and ranking tables are dropped, to be recomputed when next needed.
+
+        The new n-grams of each order are merged into the sorted table, and the parents of the next order are moved
+        to the new positions of their prefixes, so the cost grows with the size of the model but not its sort."""
+        self.logprobs, self.backoffs = {}, {}
+        self.offset_tables, self.rankings = {}, {}
+        shift = None
+        for order in range(1, max(itertools.chain(rows, self.counts)) + 1):
+            new_rows = np.asarray(rows.get(order, ()), dtype=np.int64).reshape(-1, order)
+            if counts is None or order not in rows:
+                new_counts = np.ones(len(new_rows), dtype=np.int64)
+            else:
+                new_counts = np.asarray(counts[order], dtype=np.int64)
+            if order == 1:
+                unigram = np.zeros(len(self.vocab), dtype=np.int64)
+                unigram[:len(self.counts.get(1, ()))] = self.counts.get(1, ())
+                ids, totals = sum_by_key(new_rows[:, 0], new_counts)
+                unigram[ids] += totals
+                self.counts[1] = unigram
+                continue
+            keys = np.asarray(self.keys.get(order, np.zeros(0, dtype=np.int64)))
+            if shift is not None:
+                keys = shift[keys // KEY_BASE] * KEY_BASE + keys % KEY_BASE
+            new_keys, new_counts = sum_by_key(self.index(new_rows[:, :-1]) * KEY_BASE + new_rows[:, -1], new_counts)
+            self.keys[order], self.counts[order], shift = merge_keys(
+                keys, self.counts.get(order, np.zeros(0, dtype=np.int64)), new_keys, new_counts)
+
+    def create_ngrams(self, n, cache=False):
+        """Method to create the models of every order up to n (1-5) in a single pass over the corpus."""
+        print("Creating 1-%d Gram Models" % n)
+        self.counts[1], keys, counts = count_ids(self.ids, len(self.vocab), n)
+        self.tail = self.ids[max(len(self.ids) - n + 1, 0):] if n > 1 else self.ids[:0]
+        self.keys.update(keys)
+        self.counts.update(counts)
+        if cache:
+            self.save()
+
     def create_unigram(self, cache):
         """Method to create Unigram Model for words loaded from corpus."""
         print("Creating Unigram Model")
-        unigram_file = None
-        if cache:
-            unigram_file = open('unigram.data', 'w')
         print("Calculating Count for Unigram Model")
-        unigram = Counter(self.words)
+        self.counts[1] = np.bincount(self.ids, minlength=len(self.vocab)).astype(np.int64)
         if cache:
-            unigram_file.write(str(unigram))
-            unigram_file.close()
-        self.unigram = unigram
+            self.save()
 
     def create_bigram(self, cache):
         """Method to create Bigram Model for words loaded from corpus."""
         print("Creating Bigram Model")
-        words = self.words
-        biwords = []
-        for index, item in enumerate(words):
-            if index == len(words)-1:
-                break
-            biwords.append(item+' '+words[index+1])
         print("Calculating Count for Bigram Model")
-        bigram_file = None
+        self.create_order(2)
         if cache:
-            bigram_file = open('bigram.data', 'w')
-        bigram = Counter(biwords)
-        if cache:
-            bigram_file.write(str(bigram))
-            bigram_file.close()
-        self.bigram = bigram
+            self.save()
 
     def create_trigram(self, cache):
         """Method to create Trigram Model for words loaded from corpus."""
         print("Creating Trigram Model")
-        words = self.words
-        triwords = []
-        for index, item in enumerate(words):
-            if index == len(words)-2:
-                break
-            triwords.append(item+' '+words[index+1]+' '+words[index+2])
         print("Calculating Count for Trigram Model")
+        self.create_order(3)
         if cache:
-            trigram_file = open('trigram.data', 'w')
-        trigram = Counter(triwords)
-        if cache:
-            trigram_file.write(str(trigram))
-            trigram_file.close()
-        self.trigram = trigram
+            self.save()
 
     def create_quadrigram(self, cache):
         """Method to create Quadrigram Model for words loaded from corpus."""
         print("Creating Quadrigram Model")
-        words = self.words
-        quadriwords = []
-        for index, item in enumerate(words):
-            if index == len(words)-3:
-                break
-            quadriwords.append(item+' '+words[index+1]+' '+words[index+2]+' '+words[index+3])
         print("Calculating Count for Quadrigram Model")
+        self.create_order(4)
         if cache:
-            quadrigram_file = open('fourgram.data', 'w')
-        quadrigram = Counter(quadriwords)
-        if cache:
-            quadrigram_file.write(str(quadrigram))
-            quadrigram_file.close()
-        self.quadrigram = quadrigram
+            self.save()
 
     def create_pentigram(self, cache):
         """Method to create Pentigram Model for words loaded from corpus."""
         print("Creating pentigram Model")
-        words = self.words
-        pentiwords = []
-        for index, item in enumerate(words):
-            if index == len(words)-4:
-                break
-            pentiwords.append(item+' '+words[index+1]+' '+words[index+2]+' '+words[index+3]+' '+words[index+4])
         print("Calculating Count for pentigram Model")
+        self.create_order(5)
         if cache:
-            pentigram_file = open('pentagram.data', 'w')
-        pentigram = Counter(pentiwords)
-        if cache:
-            pentigram_file.write(str(pentigram))
-            pentigram_file.close()
-        self.pentigram = pentigram
+            self.save()
+
+    def create_order(self, order):
+        """Method to count the n-grams of one order (> 1), given that the table of order-1 is already built."""
+        ids = self.ids
+        size = max(len(ids) - order + 1, 0)
+        windows = np.column_stack([ids[offset:offset + size] for offset in range(order)])
+        parent = self.index(windows[:, :-1])
+        keys = parent * KEY_BASE + windows[:, -1]
+        self.keys[order], self.counts[order] = np.unique(keys, return_counts=True)
+
+    def suffixes(self, order):
+        """Method to find the position of the (order-1)-gram suffix of every n-gram of the given order (> 1), that is
+        the n-gram without its first word, in the table of order-1."""
+        if order == 2:
+            return np.asarray(self.keys[2]) % KEY_BASE
+        return self.index(self.ngrams(order)[:, 1:])
+
+    def create_tables(self, smoothing=None):
+        """Method to precompute the smoothed log probability of every n-gram and the backoff weight of every context
+        for Kneser-Ney, Witten-Bell or stupid backoff smoothing, so that queries become table lookups.
+
+        Kneser-Ney and Witten-Bell are interpolated: the stored probability of an n-gram already includes its share
+        of the lower order estimate, and an n-gram missing from the tables gets the backoff weight of its context
+        times the probability of the n-gram without its first word. Kneser-Ney counts the lower orders by the number
+        of distinct words seen before them and discounts every order by D = n1 / (n1 + 2 * n2). Stupid backoff scores
+        relative frequencies, multiplied by STUPID_BACKOFF at every backoff step, and is not normalized. backoffs[0]
+        is the weight of the empty context, which spreads over the vocabulary for unknown words."""
+        if smoothing is not None:
+            self.smoothing = smoothing
+        self.logprobs, self.backoffs = {}, {}
+        if self.smoothing == 'laplace':
+            return
+        print("Creating %s Tables" % self.smoothing.title())
+        n = max(self.counts)
+        vocab_size = len(self.vocab)
+        counts = dict((order, np.asarray(self.counts[order], dtype=np.float64)) for order in range(1, n + 1))
+        parents = {1: np.zeros(vocab_size, dtype=np.int64)}
+        suffixes = {}
+        for order in range(2, n + 1):
+            parents[order] = np.asarray(self.keys[order]) // KEY_BASE
+            suffixes[order] = self.suffixes(order)
+        if self.smoothing == 'kneser-ney':
+            for order in range(1, n):
+                counts[order] = np.bincount(suffixes[order + 1], minlength=len(counts[order])).astype(np.float64)
+        for order in range(1, n + 1):
+            count, parent = counts[order], parents[order]
+            contexts = len(counts[order - 1]) if order > 1 else 1
+            if self.smoothing == 'stupid-backoff':
+                context_count = np.asarray(self.counts[order - 1])[parent] if order > 1 else self.token_count
+                self.logprobs[order] = np.log(count / context_count)
+                self.backoffs[order - 1] = np.full(contexts, calc.log(STUPID_BACKOFF))
+                continue
+            total = np.bincount(parent, weights=count, minlength=contexts)
+            types = np.bincount(parent, weights=count > 0, minlength=contexts)
+            lower = np.exp(self.logprobs[order - 1][suffixes[order]]) if order > 1 else 1 / vocab_size
+            if self.smoothing == 'kneser-ney':
+                n1, n2 = (count == 1).sum(), (count == 2).sum()
+                discount = n1 / (n1 + 2 * n2) if n1 else 0.5
+                alpha = np.maximum(count - discount, 0) / np.maximum(total, 1)[parent]
+                gamma = np.where(total > 0, discount * types / np.maximum(total, 1), 1)
+            else:
+                alpha = count / np.maximum(total + types, 1)[parent]
+                gamma = np.where(total > 0, types / np.maximum(total + types, 1), 1)
+            self.logprobs[order] = np.log(alpha + gamma[parent] * lower)
+            self.backoffs[order - 1] = np.log(gamma)
+
+    def smoothed(self):
+        """Method to tell whether queries use the smoothed tables, recomputing them first if they were dropped."""
+        if self.smoothing == 'laplace':
+            return False
+        if not self.logprobs:
+            self.create_tables()
+        return True
+
+    def count(self, rows):
+        """Method to look up the counts of rows of word ids, all of the same order (0 for unseen n-grams)."""
+        rows = np.asarray(rows, dtype=np.int64)
+        if rows.ndim == 1:
+            rows = rows[None, :]
+        found = self.index(rows)
+        return np.where(found >= 0, self.counts[rows.shape[1]][found.clip(0)], 0)
+
+    def offsets(self, order):
+        """Method to get the offset table of an order (> 1): the n-grams that continue the (order-1)-gram at position
+        p are at positions offsets[p] to offsets[p+1] of the table of order, because it is sorted by parent."""
+        if order not in self.offset_tables:
+            bounds = np.arange(len(self.counts[order - 1]) + 1, dtype=np.int64) * KEY_BASE
+            self.offset_tables[order] = np.searchsorted(self.keys[order], bounds)
+        return self.offset_tables[order]
+
+    def ranking(self, order):
+        """Method to get the positions of the table of an order sorted by descending count within every block of
+        n-grams that share a prefix, so that the most frequent continuations of a context come first."""
+        if order not in self.rankings:
+            counts = np.asarray(self.counts[order])
+            if order == 1:
+                self.rankings[1] = np.argsort(-counts, kind='stable')
+            else:
+                self.rankings[order] = np.lexsort((-counts, np.asarray(self.keys[order]) // KEY_BASE))
+        return self.rankings[order]
+
+    def prefix_range(self, ids, order):
+        """Method to find the range of positions in the table of the given order of the n-grams that start with a
+        list of word ids. Children of a range of parents are a range too, so it takes one offset lookup per order."""
+        found = self.find(ids)
+        if found < 0:
+            return 0, 0
+        start, end = found, found + 1
+        for step in range(len(ids) + 1, order + 1):
+            offsets = self.offsets(step)
+            start, end = int(offsets[start]), int(offsets[end])
+        return start, end
+
+    def expand(self, order, positions):
+        """Method to turn positions in the table of the given order into word id tuples, following their parents."""
+        columns = []
+        for step in range(order, 1, -1):
+            keys = np.asarray(self.keys[step])[positions]
+            columns.append(keys % KEY_BASE)
+            positions = keys // KEY_BASE
+        columns.append(np.asarray(positions, dtype=np.int64))
+        return np.column_stack(columns[::-1])
+
+    def prefix_ngrams(self, prefix, order=None):
+        """Method to list the n-grams of the given order (one more word than the prefix by default) that start with a
+        space separated prefix, with their counts, in table order. Takes time in proportion to the number found."""
+        ids = [self.word_index.get(word, -1) for word in prefix.split(' ')]
+        order = order or len(ids) + 1
+        start, end = self.prefix_range(ids, order)
+        rows = self.expand(order, np.arange(start, end))
+        return [(' '.join(self.vocab[i] for i in row), int(count))
+                for row, count in zip(rows.tolist(), np.asarray(self.counts[order])[start:end].tolist())]
+
+    def next_words(self, context, k=10):
+        """Method to list the k most frequent words that follow a context (a space separated string or a list of
+        words), with their counts, most frequent first. The longest suffix of the context of at most n-1 words that
+        was seen followed by a word is used, and an empty context gives the most frequent words. Takes time in
+        proportion to k and the length of the context."""
+        words = context.split() if isinstance(context, str) else list(context)
+        words = words[max(len(words) - max(self.counts) + 1, 0):]
+        ids = [self.word_index.get(word, -1) for word in words]
+        for start in range(len(ids) + 1):
+            order = len(ids) - start + 1
+            if order == 1:
+                begin, end = 0, len(self.vocab)
+            else:
+                begin, end = self.prefix_range(ids[start:], order)
+            if begin < end:
+                positions = self.ranking(order)[begin:min(end, begin + k)]
+                break
+        words = positions if order == 1 else np.asarray(self.keys[order])[positions] % KEY_BASE
+        return [(self.vocab[word], int(count))
+                for word, count in zip(words.tolist(), np.asarray(self.counts[order])[positions].tolist())]
+
+    def dump(self, order, file_name):
+        """Method to write the n-grams of the given order with their counts to a text file."""
+        with open(file_name, 'w') as ngram_file:
+            for row, count in zip(self.ngrams(order), self.counts[order]):
+                ngram_file.write(' '.join(self.vocab[i] for i in row) + '\t' + str(count) + '\n')
+
+    def save(self, file_name=None):
+        """Method to write the model to a binary cache file (the constructor's cache path by default): a JSON header
+        with the order, token count, corpus hash and the kinds and digests of the updates, followed by the vocabulary,
+        the key and count arrays of every order and the smoothed tables if any, each 64 byte aligned."""
+        print("Saving Model to cache file")
+        file_name = file_name or self.cache_file or CACHE_FILE
+        arrays = vocab_arrays(self.vocab) + [('tail', np.ascontiguousarray(self.tail, dtype=np.int32))]
+        for order in sorted(self.counts):
+            if order > 1:
+                arrays.append(('keys%d' % order, np.ascontiguousarray(self.keys[order], dtype=np.int64)))
+            arrays.append(('counts%d' % order, np.ascontiguousarray(self.counts[order], dtype=np.int64)))
+        for order in sorted(self.logprobs):
+            arrays.append(('logprob%d' % order, np.ascontiguousarray(self.logprobs[order], dtype=np.float64)))
+            arrays.append(('backoff%d' % (order - 1), np.ascontiguousarray(self.backoffs[order - 1], dtype=np.float64)))
+        write_model(file_name, {'format': 'counts', 'order': max(self.counts), 'token_count': int(self.token_count),
+                                'smoothing': self.smoothing,
+                                'corpus': corpus_stats(self.corpus_files),
+                                'corpus_hash': corpus_hash(self.corpus_files),
+                                'updates': self.updates}, arrays)
+
+    def load(self, file_name, n):
+        """Method to open a model saved by save() with np.memmap, so that processes loading the same file share its
+        pages. Returns False and leaves the model empty if the file is missing, holds fewer than n orders or was
+        built from a different corpus, including one with text or files added by update() or update_file() that this
+        model has not seen.
+
+        The corpus is only hashed again when the size or modification time of one of its files has changed, and if
+        the contents turn out the same the new size and time are written to the header, so the next load does not
+        hash them again. The smoothed tables are recomputed from the counts if the file holds none for the requested
+        smoothing."""
+        header, data_start = read_header(file_name)
+        if header is None or header.get('format', 'counts') != 'counts' or header['order'] < n:
+            return False
+        stats = corpus_stats(self.corpus_files)
+        if header.get('updates', []) != self.updates or (header['corpus'] != stats and
+                                                         header['corpus_hash'] != corpus_hash(self.corpus_files)):
+            print("Cache file is stale, rebuilding the model")
+            return False
+        if header['corpus'] != stats:
+            try:
+                rewrite_header(file_name, dict(header, corpus=stats), data_start)
+            except OSError:
+                pass  # a read-only cache file is still used, it is just hashed again next time
+        print("Loading Model from cache file")
+        arrays = read_arrays(file_name, header, data_start)
+        self.vocab = vocab_words(arrays)
+        self.word_index = dict((word, i) for i, word in enumerate(self.vocab))
+        self.token_count = header['token_count']
+        self.tail = np.array(arrays.get('tail', self.tail))
+        for order in range(1, header['order'] + 1):
+            if order > 1:
+                self.keys[order] = arrays['keys%d' % order]
+            self.counts[order] = arrays['counts%d' % order]
+        if header.get('smoothing', 'laplace') == self.smoothing:
+            for order in range(1, header['order'] + 1):
+                if 'logprob%d' % order in arrays:
+                    self.logprobs[order] = arrays['logprob%d' % order]
+                    self.backoffs[order - 1] = arrays['backoff%d' % (order - 1)]
+        else:
+            self.create_tables()
+        return True
+
+    def export(self, file_name, min_count=1, bits=8, min_entropy=0.0):
+        """Method to write a pruned and quantized copy of the model for serving, to be opened with QuantizedNGram.
+
+        N-grams of order 2 and up are dropped when seen fewer than min_count times (a number, or a dict by order) or
+        when their contribution to the relative entropy between the model with and without them (pruning_entropy) is
+        below min_entropy. An n-gram is kept while any of its continuations is. The log probabilities of the kept
+        n-grams are quantized to 8 or 16 bits. With add-1 smoothing the probability mass the kept continuations of a
+        context leave over, after quantizing, is spread evenly over all its continuations that are not in the table,
+        so the pruned model stays normalized at either width and gives the Laplace values up to quantization when
+        nothing is dropped (see laplace_arrays). Smoothed models keep their backoff weights (see backoff_arrays)."""
+        if bits not in (8, 16):
+            raise ValueError("bits must be 8 or 16")
+        print("Exporting Pruned and Quantized Model")
+        self.smoothed()
+        n = max(self.counts)
+        vocab_size = len(self.vocab)
+        if not isinstance(min_count, dict):
+            min_count = dict((order, min_count) for order in range(2, n + 1))
+        entropy = self.pruning_entropy() if min_entropy else {}
+        keep = {1: np.ones(vocab_size, dtype=bool)}
+        for order in range(n, 1, -1):
+            keep[order] = np.asarray(self.counts[order]) >= min_count.get(order, 1)
+            if min_entropy:
+                keep[order] &= entropy[order] >= min_entropy
+            if order < n:
+                keep[order][self.keys[order + 1][keep[order + 1]] // KEY_BASE] = True
+        arrays = vocab_arrays(self.vocab)
+        for order in range(2, n + 1):
+            position = np.cumsum(keep[order - 1]) - 1
+            keys = np.asarray(self.keys[order])[keep[order]]
+            arrays.append(('keys%d' % order, position[keys // KEY_BASE] * KEY_BASE + keys % KEY_BASE))
+        header = {'format': 'quantized', 'order': n, 'bits': bits, 'smoothing': self.smoothing}
+        if self.smoothing == 'laplace':
+            arrays += self.laplace_arrays(keep, bits)
+            header['unknown'] = -calc.log(self.token_count + vocab_size)
+        else:
+            keep[0] = np.ones(1, dtype=bool)
+            arrays += self.backoff_arrays(keep, bits)
+        write_model(file_name, header, arrays)
+
+    def pruning_entropy(self):
+        """Method to compute the pruning criterion of Stolcke (1998) for every n-gram of order 2 and up, returned as
+        a dict of arrays by order: P(h, w) * (log P(w|h) - log(backoff(h) * P(w|h'))), the relative entropy it adds to
+        the model, where h is its context, h' the context without its first word and P(h, w) the product of the
+        probabilities of its prefixes. With add-1 smoothing the backed off estimate is the share of the context's
+        left over mass that the n-gram would get if it alone were dropped (see laplace_arrays)."""
+        self.smoothed()
+        n = max(self.counts)
+        vocab_size = len(self.vocab)
+        if self.smoothing == 'laplace':
+            logprobs = {1: np.log((np.asarray(self.counts[1]) + 1) / (self.token_count + vocab_size))}
+        else:
+            logprobs = dict((order, np.asarray(self.logprobs[order])) for order in range(1, n + 1))
+        joint = logprobs[1]
+        entropy = {}
+        for order in range(2, n + 1):
+            counts = np.asarray(self.counts[order])
+            parent = np.asarray(self.keys[order]) // KEY_BASE
+            if self.smoothing == 'laplace':
+                context_counts = np.asarray(self.counts[order - 1]) + vocab_size
+                logprobs[order] = np.log((counts + 1) / context_counts[parent])
+                mass = np.bincount(parent, weights=counts + 1, minlength=len(context_counts))
+                types = np.bincount(parent, minlength=len(context_counts))
+                lower = np.log((context_counts - mass)[parent] + counts + 1) - \
+                    np.log((vocab_size - types + 1)[parent] * context_counts[parent])
+            else:
+                lower = np.asarray(self.backoffs[order - 1])[parent] + logprobs[order - 1][self.suffixes(order)]
+            joint = joint[parent] + logprobs[order]
+            entropy[order] = np.exp(joint) * (logprobs[order] - lower)
+        return entropy
+
+    def laplace_arrays(self, keep, bits):
+        """Method to quantize the add-1 log probabilities of the kept n-grams for export(), along with the log
+        probability of a continuation missing from the table for every kept context.
+
+        The latter is one float32 per context, computed from the mass the quantized probabilities of its kept
+        continuations leave over rather than quantized itself: it is shared by every missing continuation, so a
+        rounding error in it would be multiplied by their number. In the contexts where rounding to the nearest level
+        leaves less than half the mass that was left before quantizing, the kept probabilities are rounded down."""
+        vocab_size = len(self.vocab)
+        codes, codebook = quantize(np.log((np.asarray(self.counts[1]) + 1) / (self.token_count + vocab_size)), bits)
+        arrays = [('logprob1', codes), ('codebook1', codebook)]
+        for order in range(2, max(self.counts) + 1):
+            counts = np.asarray(self.counts[order])[keep[order]] + 1
+            parent = np.asarray(self.keys[order])[keep[order]] // KEY_BASE
+            context_counts = np.asarray(self.counts[order - 1])
+            logprob = np.log(counts / (context_counts[parent] + vocab_size))
+            codes, codebook = quantize(logprob, bits)
+            left = 1 - np.bincount(parent, weights=np.exp(logprob), minlength=len(context_counts))
+            quantized_left = 1 - np.bincount(parent, weights=np.exp(codebook[codes]), minlength=len(context_counts))
+            down = (quantized_left < left / 2)[parent]
+            codes[down] = (np.searchsorted(codebook, logprob[down], side='right') - 1).clip(0)
+            mass = np.bincount(parent, weights=np.exp(codebook[codes]), minlength=len(context_counts))[keep[order - 1]]
+            types = np.bincount(parent, minlength=len(context_counts))[keep[order - 1]]
+            left = np.maximum(1 - mass, 1 / (context_counts[keep[order - 1]] + vocab_size))
+            floor = np.log(left / np.maximum(vocab_size - types, 1)).astype(np.float32)
+            arrays += [('floor%d' % (order - 1), floor)]
+            arrays += [('logprob%d' % order, codes), ('codebook%d' % order, codebook)]
+        return arrays
+
+    def backoff_arrays(self, keep, bits):
+        """Method to quantize the smoothed log probabilities of the kept n-grams and the backoff weights of the kept
+        contexts for export(). The backoff weights of Kneser-Ney and Witten-Bell contexts that lost continuations are
+        recomputed so that the mass of those goes to the lower order estimate and the pruned model stays normalized."""
+        n = max(self.counts)
+        backoffs = dict((order, np.asarray(self.backoffs[order])) for order in range(n))
+        arrays = []
+        for order in range(1, n + 1):
+            logprob = np.asarray(self.logprobs[order])
+            if order > 1 and self.smoothing != 'stupid-backoff' and not keep[order].all():
+                parent = np.asarray(self.keys[order]) // KEY_BASE
+                lower = np.exp(np.asarray(self.logprobs[order - 1])[self.suffixes(order)])
+                contexts = len(backoffs[order - 1])
+                dropped = ~keep[order]
+                unseen = np.maximum(1 - np.bincount(parent, weights=lower, minlength=contexts), 0)
+                left = np.bincount(parent[dropped], weights=np.exp(logprob[dropped]), minlength=contexts) + \
+                    np.exp(backoffs[order - 1]) * unseen
+                lower_left = np.bincount(parent[dropped], weights=lower[dropped], minlength=contexts) + unseen
+                changed = np.bincount(parent[dropped], minlength=contexts) > 0
+                backoffs[order - 1] = backoffs[order - 1].copy()
+                backoffs[order - 1][changed] = np.log(left[changed] / lower_left[changed])
+            codes, codebook = quantize(logprob[keep[order]], bits)
+            arrays += [('logprob%d' % order, codes), ('codebook%d' % order, codebook)]
+        for order in range(n):
+            codes, codebook = quantize(backoffs[order][keep[order]], bits)
+            arrays += [('backoff%d' % order, codes), ('backoff_codebook%d' % order, codebook)]
+        return arrays
+
+    def prune_report(self, sentences, n=None, settings=((1, 16), (2, 16), (2, 8), (3, 8), (5, 8))):
+        """Method to export the model with each (min_count, bits) setting and report the file size and the perplexity
+        on held-out sentences of each, after those of the full model, to help choose a setting for serving. The report
+        is printed and returned as a list of dicts."""
+        n = n or max(self.counts)
+        self.smoothed()
+        size = sum(array.nbytes for name, array in vocab_arrays(self.vocab)) + \
+            sum(np.asarray(array).nbytes for array in itertools.chain(self.keys.values(), self.counts.values(),
+                                                                      self.logprobs.values(), self.backoffs.values()))
+        report = [{'min_count': None, 'bits': 64, 'size': size, 'perplexity': self.perplexity(sentences, n)}]
+        for min_count, bits in settings:
+            handle, file_name = tempfile.mkstemp(suffix='.model')
+            os.close(handle)
+            try:
+                self.export(file_name, min_count, bits)
+                model = QuantizedNGram(file_name)
+                report.append({'min_count': min_count, 'bits': bits, 'size': os.path.getsize(file_name),
+                               'perplexity': model.perplexity(sentences, n)})
+                del model
+            finally:
+                os.remove(file_name)
+        print("min_count  bits        size  perplexity")
+        for row in report:
+            print("%9s  %4d  %10d  %10.2f" % (row['min_count'] or '-', row['bits'], row['size'], row['perplexity']))
+        return report
+
+    def frequency(self, words):
+        """Method to look up the count of a space separated n-gram string, one table search per word."""
+        ids = [self.word_index.get(word, -1) for word in words.split(' ')]
+        found = self.find(ids)
+        return 0 if found < 0 else int(self.counts[len(ids)][found])
 
     def probability(self, word, words="", n=1):
         """Method to calculate the Maximum Likelihood Probability of n-Grams on the basis of various parameters."""
+        if self.smoothed():
+            return self.backoff_probability([self.word_index.get(item, -1) for item in
+                                             (word if n == 1 else words).split(' ')])
         if n == 1:
-            return calc.log((self.unigram[word]+1)/(len(self.words)+len(self.unigram)))
-        elif n == 2:
-            return calc.log((self.bigram[words]+1)/(self.unigram[word]+len(self.unigram)))
-        elif n == 3:
-            return calc.log((self.trigram[words]+1)/(self.bigram[word]+len(self.unigram)))
-        elif n == 4:
-            return calc.log((self.quadrigram[words]+1)/(self.trigram[word]+len(self.unigram)))
-        elif n == 5:
-            return calc.log((self.pentigram[words]+1)/(self.quadrigram[word]+len(self.unigram)))
+            return calc.log((self.frequency(word)+1)/(self.token_count+len(self.vocab)))
+        elif 2 <= n <= 5:
+            return calc.log((self.frequency(words)+1)/(self.frequency(word)+len(self.vocab)))
 
-    def sentence_probability(self, sentence, n=1, form='antilog'):
-        """Method to calculate cumulative n-gram Maximum Likelihood Probability of a phrase or sentence."""
-        words = sentence.lower().split()
-        P = 0
+    def log_probabilities(self, rows):
+        """Method to calculate the log probability of the last word of each row of word ids given the words before it,
+        as in probability()."""
+        if self.smoothed():
+            return self.backoff_probabilities(rows)
+        rows = np.asarray(rows, dtype=np.int64)
+        n = rows.shape[1]
+        vocab_size = len(self.vocab)
         if n == 1:
-            for index, item in enumerate(words):
-                P += self.probability(item)
-        if n == 2:
-            for index, item in enumerate(words):
-                if index >= len(words) - 1:
-                    break
-                P += self.probability(item, item+' '+words[index+1], 2)
-        if n == 3:
-            for index, item in enumerate(words):
-                if index >= len(words) - 2:
-                    break
-                P += self.probability(item+' '+words[index+1], item+' '+words[index+1]+' '+words[index+2], 3)
-        if n == 4:
-            for index, item in enumerate(words):
-                if index >= len(words) - 3:
-                    break
-                P += self.probability(item+' '+words[index+1]+' '+words[index+2], item+' '+words[index+1]+' ' +
-                                      words[index+2]+' '+words[index+3], 4)
-        if n == 5:
-            for index, item in enumerate(words):
-                if index >= len(words) - 4:
-                    break
-                P += self.probability(item+' '+words[index+1]+' '+words[index+2]+' '+words[index+3], item+' ' +
-                                      words[index+1]+' '+words[index+2]+' '+words[index+3]+' '+words[index+4], 5)
-        if form == 'log':
-            return P
-        elif form == 'antilog':
-            return calc.pow(calc.e, P)
+            return np.log((self.count(rows) + 1) / (self.token_count + vocab_size))
+        context = self.index(rows[:, :-1])
+        found = self.extend(context, rows[:, -1], n)
+        context_count = np.where(context >= 0, self.counts[n - 1][context.clip(0)], 0)
+        count = np.where(found >= 0, self.counts[n][found.clip(0)], 0)
+        return np.log((count + 1) / (context_count + vocab_size))
+
+    def backoff_probability(self, ids):
+        """Method to look up the smoothed log probability of one n-gram given as a list of word ids, backing off to
+        shorter contexts until it is found in the tables."""
+        weight = 0
+        for start in range(len(ids)):
+            order = len(ids) - start
+            found = self.find(ids[start:])
+            if found >= 0:
+                return weight + float(self.logprobs[order][found])
+            context = self.find(ids[start:-1]) if order > 1 else 0
+            if context >= 0:
+                weight += float(self.backoffs[order - 1][context])
+            elif self.smoothing == 'stupid-backoff':
+                weight += calc.log(STUPID_BACKOFF)
+        return weight - calc.log(len(self.vocab))
+
+
+class QuantizedNGram(nGramIndex):
+    """A pruned n-Gram model with quantized log probabilities, written by nGram.export() for serving in little memory.
+    Its arrays are memory-mapped from the file and it is queried like the nGram it was exported from.
+    file_name: path of the exported model
+
+Usage:
+>>> nGram(n=5, corpus_file=None).export('ngram.q8', min_count=2, bits=8)
+>>> qng = QuantizedNGram('ngram.q8')
+>>> print(qng.sentence_probability(sentence='hold your horses', n=2, form='log'))
+"""
+    def __init__(self, file_name):
+        """Constructor method which memory-maps an exported model."""
+        header, data_start = read_header(file_name)
+        if header is None or header.get('format') != 'quantized':
+            raise ValueError("%s is not an exported n-gram model" % file_name)
+        arrays = read_arrays(file_name, header, data_start)
+        self.vocab = vocab_words(arrays)
+        self.word_index = dict((word, i) for i, word in enumerate(self.vocab))
+        self.order = header['order']
+        self.smoothing = header.get('smoothing', 'laplace')
+        self.keys = dict((order, arrays['keys%d' % order]) for order in range(2, self.order + 1))
+        self.logprobs = dict((order, (arrays['logprob%d' % order], arrays['codebook%d' % order]))
+                             for order in range(1, self.order + 1))
+        if self.smoothing == 'laplace':
+            self.unknown = header['unknown']
+            self.floors = dict((order, arrays['floor%d' % order]) for order in range(1, self.order))
+        else:
+            self.backoffs = dict((order, (arrays['backoff%d' % order], arrays['backoff_codebook%d' % order]))
+                                 for order in range(self.order))
+
+    def lookup(self, table, found, default):
+        """Method to decode the quantized values of a table at the given positions (default where a position is -1)."""
+        codes, codebook = table
+        return np.where(found >= 0, codebook[codes[found.clip(0)]], default)
+
+    def probability(self, word, words="", n=1):
+        """Method to look up the log probability of an n-Gram, with the same parameters as nGram.probability()."""
+        ids = self.encode((word if n == 1 else words).split(' '))
+        return float(self.log_probabilities(ids[None, :])[0])
+
+    def log_probabilities(self, rows):
+        """Method to look up the log probability of the last word of each row of word ids given the words before it.
+        Continuations missing from the table get the share of their context's left over probability mass, and
+        unseen contexts a uniform distribution over the vocabulary. Smoothed models back off as nGram does."""
+        if self.smoothing != 'laplace':
+            return self.backoff_probabilities(rows)
+        rows = np.asarray(rows, dtype=np.int64)
+        n = rows.shape[1]
+        if n == 1:
+            return self.lookup(self.logprobs[1], self.index(rows), self.unknown)
+        context = self.index(rows[:, :-1])
+        found = self.extend(context, rows[:, -1], n)
+        floor = nGramIndex.lookup(self, self.floors[n - 1], context, -calc.log(len(self.vocab)))
+        return np.where(found >= 0, self.lookup(self.logprobs[n], found, 0), floor)
 
 help(nGram)
@@ -1,7 +1,15 @@
+import os
+import tempfile
+import time
 import unittest
-from ngram import nGram
+import numpy as np
+from ngram import nGram, QuantizedNGram, corpus_stats, read_header
 ng = nGram(n=5, corpus_file=None, cache=False)
 
+BENCHMARK_TOKENS = 10000000
+BENCHMARK_SENTENCES = 100000
+SENTENCES = ['hold your horses', 'Hold your horses and hold them', '', 'horses', 'your horses hold your horses now']
+
 
 class TestNgram(unittest.TestCase):
     def test_uni_log(self):
@@ -44,6 +52,354 @@ class TestNgram(unittest.TestCase):
         probability = ng.sentence_probability(sentence='hold your horses', n=5, form='antilog')
         self.assertAlmostEqual(probability, 1)
 
+    def test_single_pass_matches_per_order(self):
+        ng.create_bigram(False)
+        ng.create_trigram(False)
+        ng.create_quadrigram(False)
+        ng.create_pentigram(False)
+        per_order = dict((order, (ng.keys[order], ng.counts[order])) for order in range(2, 6))
+        ng.create_ngrams(5)
+        for order in range(2, 6):
+            np.testing.assert_array_equal(ng.keys[order], per_order[order][0])
+            np.testing.assert_array_equal(ng.counts[order], per_order[order][1])
+
+    def test_stream_matches_in_memory(self):
+        streamed = nGram(n=5, corpus_file=None, stream=True, chunk_size=4096)
+        self.assertEqual(streamed.vocab, ng.vocab)
+        self.assertEqual(streamed.token_count, ng.token_count)
+        np.testing.assert_array_equal(streamed.counts[1], ng.counts[1])
+        for order in range(2, 6):
+            np.testing.assert_array_equal(streamed.keys[order], ng.keys[order])
+            np.testing.assert_array_equal(streamed.counts[order], ng.counts[order])
+
+    def test_parallel_matches_serial(self):
+        for processes in (2, 3):
+            parallel = nGram(n=5, corpus_file=None, processes=processes)
+            self.assertEqual(parallel.vocab, ng.vocab)
+            self.assertEqual(parallel.token_count, ng.token_count)
+            np.testing.assert_array_equal(parallel.counts[1], ng.counts[1])
+            for order in range(2, 6):
+                np.testing.assert_array_equal(parallel.keys[order], ng.keys[order])
+                np.testing.assert_array_equal(parallel.counts[order], ng.counts[order])
+
+    def test_score_batch_matches_sentence_probability(self):
+        for n in range(1, 6):
+            expected = [ng.sentence_probability(sentence=sentence, n=n, form='log') for sentence in SENTENCES]
+            np.testing.assert_allclose(ng.score_batch(SENTENCES, n=n), expected)
+
+    def test_cache_round_trip(self):
+        cache_file = tempfile.NamedTemporaryFile(suffix='.model', delete=False)
+        cache_file.close()
+        try:
+            ng.save(cache_file.name)
+            cached = nGram(n=5, corpus_file=None, cache=cache_file.name)
+            self.assertIsInstance(cached.counts[5], np.memmap)
+            self.assertEqual(cached.vocab, ng.vocab)
+            for n in range(1, 6):
+                self.assertAlmostEqual(cached.sentence_probability(sentence='hold your horses', n=n, form='log'),
+                                       ng.sentence_probability(sentence='hold your horses', n=n, form='log'))
+        finally:
+            os.remove(cache_file.name)
+
+    def test_stale_cache_is_rebuilt(self):
+        corpus_file = tempfile.NamedTemporaryFile('w', suffix='.data', delete=False)
+        corpus_file.write('hold your horses')
+        corpus_file.close()
+        cache_file = corpus_file.name + '.model'
+        try:
+            nGram(n=2, corpus_file=corpus_file.name, cache=cache_file)
+            with open(corpus_file.name, 'a') as corpus:
+                corpus.write(' hold your')
+            rebuilt = nGram(n=2, corpus_file=corpus_file.name, cache=cache_file)
+            self.assertEqual(rebuilt.token_count, 5)
+            self.assertEqual(rebuilt.frequency('hold your'), 2)
+        finally:
+            os.remove(corpus_file.name)
+            os.remove(cache_file)
+
+    def test_touched_corpus_refreshes_cache_header(self):
+        corpus_file = tempfile.NamedTemporaryFile('w', suffix='.data', delete=False)
+        corpus_file.write('hold your horses')
+        corpus_file.close()
+        cache_file = corpus_file.name + '.model'
+        try:
+            nGram(n=2, corpus_file=corpus_file.name, cache=cache_file)
+            os.utime(corpus_file.name, (0, 0))
+            cached = nGram(n=2, corpus_file=corpus_file.name, cache=cache_file)
+            self.assertIsInstance(cached.counts[2], np.memmap)
+            self.assertEqual(read_header(cache_file)[0]['corpus'], corpus_stats([corpus_file.name]))
+            cached = nGram(n=2, corpus_file=corpus_file.name, cache=cache_file)
+            self.assertEqual(cached.frequency('hold your'), 1)
+        finally:
+            os.remove(corpus_file.name)
+            os.remove(cache_file)
+
+    def test_updated_cache_is_not_loaded_as_corpus(self):
+        corpus_file = tempfile.NamedTemporaryFile('w', suffix='.data', delete=False)
+        corpus_file.write('hold your horses')
+        corpus_file.close()
+        cache_file = corpus_file.name + '.model'
+        try:
+            updated = nGram(n=2, corpus_file=corpus_file.name, cache=cache_file)
+            updated.update('hold your hat')
+            updated.save()
+            rebuilt = nGram(n=2, corpus_file=corpus_file.name, cache=cache_file)
+            self.assertEqual(rebuilt.token_count, 3)
+            self.assertEqual(rebuilt.frequency('hold your'), 1)
+            cached = nGram(n=2, corpus_file=corpus_file.name, cache=cache_file)
+            self.assertIsInstance(cached.counts[2], np.memmap)
+            self.assertEqual(cached.token_count, 3)
+        finally:
+            os.remove(corpus_file.name)
+            os.remove(cache_file)
+
+    def test_update_file_cache_is_not_loaded_as_corpus(self):
+        corpus_files = []
+        for text in ('hold your horses', 'your horses hold'):
+            corpus_file = tempfile.NamedTemporaryFile('w', suffix='.data', delete=False)
+            corpus_file.write(text)
+            corpus_file.close()
+            corpus_files.append(corpus_file.name)
+        cache_file = corpus_files[0] + '.model'
+        try:
+            updated = nGram(n=2, corpus_file=corpus_files[:1], stream=True, cache=cache_file)
+            updated.update_file(corpus_files[1])
+            self.assertEqual(updated.frequency('horses your'), 1)
+            updated.save()
+            rebuilt = nGram(n=2, corpus_file=corpus_files, stream=True, cache=cache_file)
+            self.assertNotIsInstance(rebuilt.counts[2], np.memmap)
+            self.assertEqual(rebuilt.frequency('horses your'), 0)
+        finally:
+            for file_name in corpus_files + [cache_file]:
+                os.remove(file_name)
+
+    def test_export_matches_unpruned_model(self):
+        model_file = tempfile.NamedTemporaryFile(suffix='.model', delete=False)
+        model_file.close()
+        try:
+            ng.export(model_file.name, min_count=1, bits=16)
+            quantized = QuantizedNGram(model_file.name)
+            for n in range(1, 6):
+                np.testing.assert_allclose(quantized.score_batch(SENTENCES, n=n), ng.score_batch(SENTENCES, n=n),
+                                           atol=0.05)
+        finally:
+            os.remove(model_file.name)
+
+    def test_pruned_model_is_normalized(self):
+        words = (np.random.RandomState(0).zipf(1.5, 5000) % 300).astype(str)
+        corpus_file = tempfile.NamedTemporaryFile('w', suffix='.data', delete=False)
+        corpus_file.write(' '.join(words))
+        corpus_file.close()
+        model_file = corpus_file.name + '.model'
+        try:
+            small = nGram(n=3, corpus_file=corpus_file.name)
+            words = np.arange(len(small.vocab))
+            for bits in (8, 16):
+                small.export(model_file, min_count=2, bits=bits)
+                quantized = QuantizedNGram(model_file)
+                self.assertLess(len(quantized.keys[3]), len(small.keys[3]))
+                for order in (1, 2):
+                    contexts = small.ngrams(order)
+                    rows = np.column_stack((np.repeat(contexts, len(words), axis=0), np.tile(words, len(contexts))))
+                    sums = np.exp(quantized.log_probabilities(rows)).reshape(len(contexts), len(words)).sum(axis=1)
+                    np.testing.assert_allclose(sums, 1, atol=1e-5)
+                del quantized
+        finally:
+            os.remove(corpus_file.name)
+            if os.path.exists(model_file):
+                os.remove(model_file)
+
+    def test_pruning_entropy_matches_definition(self):
+        smoothed = nGram(n=3, corpus_file=None, smoothing='kneser-ney')
+        rows = smoothed.ngrams(3)[:50]
+        joint = sum(smoothed.log_probabilities(rows[:, :order]) for order in range(1, 4))
+        backoff = smoothed.backoffs[2][smoothed.index(rows[:, :2])]
+        lower = backoff + smoothed.log_probabilities(rows[:, 1:])
+        expected = np.exp(joint) * (smoothed.log_probabilities(rows) - lower)
+        np.testing.assert_allclose(smoothed.pruning_entropy()[3][:50], expected)
+
+    def test_entropy_pruned_model_is_normalized(self):
+        model_file = tempfile.NamedTemporaryFile(suffix='.model', delete=False)
+        model_file.close()
+        try:
+            entropy = ng.pruning_entropy()
+            self.assertTrue(all((entropy[order] > 0).all() for order in entropy))
+            ng.export(model_file.name, bits=16, min_entropy=np.median(entropy[5]))
+            quantized = QuantizedNGram(model_file.name)
+            self.assertLess(len(quantized.keys[5]), len(ng.keys[5]))
+            context = ng.encode(['hold', 'your'])
+            rows = np.column_stack((np.tile(context, (len(ng.vocab), 1)), np.arange(len(ng.vocab))))
+            self.assertAlmostEqual(np.exp(quantized.log_probabilities(rows)).sum(), 1, places=5)
+        finally:
+            os.remove(model_file.name)
+
+    def test_smoothed_models_are_normalized(self):
+        for smoothing in ('kneser-ney', 'witten-bell'):
+            smoothed = nGram(n=3, corpus_file=None, smoothing=smoothing)
+            words = np.arange(len(smoothed.vocab))
+            for context in (['hold', 'your'], ['your', 'unseenword']):
+                ids = smoothed.encode(context)
+                rows = np.column_stack((np.tile(ids, (len(words), 1)), words))
+                self.assertAlmostEqual(np.exp(smoothed.log_probabilities(rows)).sum(), 1)
+
+    def test_backoff_lookup_matches_score_batch(self):
+        for smoothing in ('kneser-ney', 'witten-bell', 'stupid-backoff'):
+            smoothed = nGram(n=5, corpus_file=None, smoothing=smoothing)
+            for n in range(1, 6):
+                expected = [smoothed.sentence_probability(sentence=sentence, n=n, form='log') for sentence in SENTENCES]
+                np.testing.assert_allclose(smoothed.score_batch(SENTENCES, n=n), expected)
+
+    def test_smoothed_cache_round_trip(self):
+        cache_file = tempfile.NamedTemporaryFile(suffix='.model', delete=False)
+        cache_file.close()
+        try:
+            smoothed = nGram(n=3, corpus_file=None, cache=cache_file.name, smoothing='kneser-ney')
+            cached = nGram(n=3, corpus_file=None, cache=cache_file.name, smoothing='kneser-ney')
+            self.assertIsInstance(cached.logprobs[3], np.memmap)
+            np.testing.assert_allclose(cached.score_batch(SENTENCES, n=3), smoothed.score_batch(SENTENCES, n=3))
+            rebuilt = nGram(n=3, corpus_file=None, cache=cache_file.name, smoothing='witten-bell')
+            self.assertEqual(rebuilt.smoothing, 'witten-bell')
+            self.assertNotIsInstance(rebuilt.logprobs[3], np.memmap)
+        finally:
+            os.remove(cache_file.name)
+
+    def test_update_matches_rebuild(self):
+        words = open('corpus.data').read().split(' ')
+        half = len(words) // 2
+        corpus_file = tempfile.NamedTemporaryFile('w', suffix='.data', delete=False)
+        corpus_file.write(' '.join(words[:half]))
+        corpus_file.close()
+        try:
+            updated = nGram(n=5, corpus_file=corpus_file.name, smoothing='kneser-ney')
+            updated.update(' '.join(words[half:]))
+            self.assertEqual(updated.logprobs, {})
+            self.assertEqual(updated.vocab, ng.vocab)
+            self.assertEqual(updated.token_count, ng.token_count)
+            for order in range(2, 6):
+                np.testing.assert_array_equal(updated.keys[order], ng.keys[order])
+                np.testing.assert_array_equal(updated.counts[order], ng.counts[order])
+            rebuilt = nGram(n=5, corpus_file=None, smoothing='kneser-ney')
+            np.testing.assert_allclose(updated.score_batch(SENTENCES, n=5), rebuilt.score_batch(SENTENCES, n=5))
+        finally:
+            os.remove(corpus_file.name)
+
+    def test_next_words_matches_scan(self):
+        rows = ng.ngrams(3)
+        for context in ('hold your', 'your horses'):
+            ids = ng.encode(context.split(' '))
+            match = (rows[:, 0] == ids[0]) & (rows[:, 1] == ids[1])
+            expected = sorted(ng.counts[3][match], reverse=True)[:5]
+            self.assertEqual([count for word, count in ng.next_words(context, 5)], expected)
+            for word, count in ng.next_words(context, 5):
+                self.assertEqual(ng.frequency(context + ' ' + word), count)
+
+    def test_prefix_ngrams_matches_scan(self):
+        rows = ng.ngrams(4)
+        ids = ng.encode(['hold', 'your'])
+        match = (rows[:, 0] == ids[0]) & (rows[:, 1] == ids[1])
+        expected = [(' '.join(ng.vocab[i] for i in row), count) for row, count in zip(rows[match], ng.counts[4][match])]
+        self.assertEqual(ng.prefix_ngrams('hold your', 4), expected)
+        self.assertEqual(ng.prefix_ngrams('unseenword your'), [])
+
+
+@unittest.skipUnless(os.environ.get('NGRAM_BENCHMARK'), 'set NGRAM_BENCHMARK=1 to run the benchmarks')
+class BenchmarkNgram(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        words = (np.random.RandomState(0).zipf(1.3, BENCHMARK_TOKENS) % 50000).astype(str)
+        corpus_file = tempfile.NamedTemporaryFile('w', suffix='.data', delete=False)
+        corpus_file.write(' '.join(words))
+        corpus_file.close()
+        cls.corpus_path = corpus_file.name
+        cls.ng = nGram(n=5, corpus_file=cls.corpus_path)
+
+    @classmethod
+    def tearDownClass(cls):
+        os.remove(cls.corpus_path)
+
+    def test_single_pass_vs_per_order(self):
+        start = time.time()
+        self.ng.create_bigram(False)
+        self.ng.create_trigram(False)
+        self.ng.create_quadrigram(False)
+        self.ng.create_pentigram(False)
+        per_order = time.time() - start
+        start = time.time()
+        self.ng.create_ngrams(5)
+        single_pass = time.time() - start
+        print("\n%d tokens, orders 2-5: per-order builders %.2fs, single pass %.2fs (%.1fx)"
+              % (BENCHMARK_TOKENS, per_order, single_pass, per_order / single_pass))
+
+    def test_parallel_vs_serial(self):
+        start = time.time()
+        nGram(n=5, corpus_file=self.corpus_path)
+        serial = time.time() - start
+        merge_shards = nGram.merge_shards
+        merged = []
+
+        def timed_merge(model, *args):
+            start = time.time()
+            merge_shards(model, *args)
+            merged.append(time.time() - start)
+
+        nGram.merge_shards = timed_merge
+        try:
+            for processes in (2, 4, 8):
+                start = time.time()
+                nGram(n=5, corpus_file=self.corpus_path, processes=processes)
+                parallel = time.time() - start
+                print("\n%d tokens, n=5: serial %.2fs, %d processes %.2fs (%.1fx), merge in the parent %.2fs (%.0f%%)"
+                      % (BENCHMARK_TOKENS, serial, processes, parallel, serial / parallel, merged[-1],
+                         100 * merged[-1] / parallel))
+                # the merge is the part that more processes do not speed up
+                self.assertLess(merged[-1], serial / 2)
+        finally:
+            nGram.merge_shards = merge_shards
+
+    def test_score_batch_vs_loop(self):
+        rng = np.random.RandomState(1)
+        sentences = [' '.join(self.ng.vocab[i] for i in rng.randint(0, 1000, rng.randint(1, 20)))
+                     for _ in range(BENCHMARK_SENTENCES)]
+        for n in range(1, 6):
+            start = time.time()
+            loop = [self.ng.sentence_probability(sentence=sentence, n=n, form='log') for sentence in sentences]
+            per_sentence = time.time() - start
+            start = time.time()
+            batch = self.ng.score_batch(sentences, n=n)
+            batched = time.time() - start
+            np.testing.assert_allclose(batch, loop)
+            print("\n%d sentences, n=%d: sentence_probability loop %.2fs, score_batch %.2fs (%.1fx)"
+                  % (BENCHMARK_SENTENCES, n, per_sentence, batched, per_sentence / batched))
+
+    def test_update_vs_rebuild(self):
+        words = (np.random.RandomState(2).zipf(1.3, BENCHMARK_TOKENS // 100) % 50000).astype(str)
+        start = time.time()
+        model = nGram(n=5, corpus_file=self.corpus_path)
+        rebuild = time.time() - start
+        start = time.time()
+        model.update(' '.join(words))
+        update = time.time() - start
+        print("\n%d tokens, n=5: rebuild %.2fs, update with %d tokens %.2fs (%.1fx)"
+              % (BENCHMARK_TOKENS, rebuild, len(words), update, rebuild / update))
+
+    def test_next_words_vs_scan(self):
+        trigram = dict((' '.join(self.ng.vocab[i] for i in row), count)
+                       for row, count in zip(self.ng.ngrams(3).tolist(), self.ng.counts[3].tolist()))
+        rng = np.random.RandomState(3)
+        contexts = [' '.join(self.ng.vocab[i] for i in rng.randint(0, 100, 2)) for _ in range(20)]
+        start = time.time()
+        for context in contexts:
+            found = [(ngram.rsplit(' ', 1)[1], count) for ngram, count in trigram.items()
+                     if ngram.rsplit(' ', 1)[0] == context]
+            sorted(found, key=lambda item: -item[1])[:10]
+        scan = (time.time() - start) / len(contexts)
+        start = time.time()
+        for context in contexts * 1000:
+            self.ng.next_words(context, 10)
+        lookup = (time.time() - start) / len(contexts) / 1000
+        print("\n%d trigrams: linear scan %.1fms, next_words %.1fus per query (%.0fx)"
+              % (len(trigram), scan * 1e3, lookup * 1e6, scan / lookup))
+
 
 if "__name__" == "__main__":
     unittest.main()
\ No newline at end of file
@@ -2,9 +2,10 @@
 
 import tensorflow as tf
 import numpy as np
-import math
+import time
 import sys
 
+import common
 from config import FLAGS
 from model import Seq2Seq
 from dialog import Dialog
@@ -35,47 +36,108 @@ class ChatBot:
 
             line = sys.stdin.readline()
 
-    def decode(self, enc_input, dec_input):
-        if type(dec_input) is np.ndarray:
-            dec_input = dec_input.tolist()
-
-        # TODO: 구글처럼 시퀀스 사이즈에 따라 적당한 버킷을 사용하도록 만들어서 사용하도록
-        input_len = int(math.ceil((len(enc_input) + 1) * 1.5))
-
-        enc_input, dec_input, _ = self.dialog.transform(enc_input, dec_input,
-                                                        input_len,
-                                                        FLAGS.max_decode_len)
-
-        return self.model.predict(self.sess, [enc_input], [dec_input])
+    def input_len(self, enc_input):
+        return common.input_len(self.dialog.buckets, enc_input)
 
     def get_replay(self, msg):
         enc_input = self.dialog.tokenizer(msg)
         enc_input = self.dialog.tokens_to_ids(enc_input)
-        dec_input = []
+        enc_input = self.dialog.pad_input(enc_input, self.input_len(enc_input))
 
-        # TODO: 구글처럼 Seq2Seq2 모델 안의 RNN 셀을 생성하는 부분에 넣을것
-        #       입력값에 따라 디코더셀의 상태를 순차적으로 구성하도록 함
-        #       여기서는 최종 출력값을 사용하여 점진적으로 시퀀스를 만드는 방식을 사용
-        #       다만 상황에 따라서는 이런 방식이 더 유연할 수도 있을 듯
-        curr_seq = 0
-        for i in range(FLAGS.max_decode_len):
-            outputs = self.decode(enc_input, dec_input)
-            if self.dialog.is_eos(outputs[0][curr_seq]):
-                break
-            elif self.dialog.is_defined(outputs[0][curr_seq]) is not True:
-                dec_input.append(outputs[0][curr_seq])
-                curr_seq += 1
+        if FLAGS.beam_width > 1:
+            dec_input = self.beam_search(enc_input, FLAGS.beam_width, FLAGS.length_penalty)
+            return self.dialog.decode([dec_input], True)
+
+        # inference.py 의 numpy 모델과 같은 greedy 디코딩 (common.greedy_decode)
+        dec_input = common.greedy_decode(self.model, self.sess, enc_input, FLAGS.max_decode_len)
 
         reply = self.dialog.decode([dec_input], True)
 
         return reply
 
+    # 빔 서치: 살아있는 가설 beam_width 개의 상태를 한 배치로 묶어 스텝마다 session.run 을 한 번만 한다.
+    # 점수는 GNMT 방식의 길이 정규화 ((5 + 길이) / 6) ** length_penalty 로 나눈 log 확률이다.
+    def beam_search(self, enc_input, beam_width, length_penalty):
+        def normalize(scores, length):
+            return scores / (((5.0 + length) / 6.0) ** length_penalty)
+
+        states = self.model.encode(self.sess, [enc_input])
+        curr_ids = np.array([self.dialog._STA_ID_], dtype=np.int32)
+        scores = np.zeros(1)
+        history = np.zeros((1, 0), dtype=np.int32)
+        finished = []  # (정규화 점수, 단어 id 배열)
+        steps = 0  # 디코딩한 스텝 수. 완성된 가설은 EOS 까지 센다.
+
+        for i in range(FLAGS.max_decode_len):
+            steps = i + 1
+            log_probs, states = self.model.decode_step(self.sess, curr_ids, states)
+            total = (scores[:, None] + log_probs).ravel()
+
+            # 모든 가설의 후보 중 상위 2 * beam_width 개: EOS 로 끝난 후보를 빼도 beam_width 개가 남는다.
+            n_best = min(2 * beam_width, len(total))
+            best = np.argpartition(-total, n_best - 1)[:n_best]
+            best = best[np.argsort(-total[best])]
+            parents, tokens = np.divmod(best, log_probs.shape[1])
+
+            eos = tokens == self.dialog._EOS_ID_
+            for j in np.flatnonzero(eos[:beam_width]):
+                finished.append((normalize(total[best[j]], steps), history[parents[j]]))
+
+            alive = np.flatnonzero(~eos)[:beam_width]
+            scores = total[best[alive]]
+            curr_ids = tokens[alive].astype(np.int32)
+            history = np.column_stack([history[parents[alive]], curr_ids])
+            states = select_states(states, parents[alive])
+
+            # 조기 종료: 완성된 가설이 beam_width 개 모였거나, 살아있는 가장 좋은 가설이 가장 유리한 길이
+            # (max_decode_len, 길이 정규화로 나누는 값이 가장 크다)에서도 가장 좋은 완성 가설보다 나쁘면 멈춘다.
+            # log 확률은 스텝마다 줄어들기만 하므로 살아있는 가설이 이보다 좋은 점수를 받을 수 없다.
+            if finished:
+                finished.sort(key=lambda hypothesis: -hypothesis[0])
+                if len(finished) >= beam_width or \
+                        normalize(scores.max(), FLAGS.max_decode_len) < finished[0][0]:
+                    break
+
+        if not finished:
+            finished = [(normalize(score, steps), ids) for score, ids in zip(scores, history)]
+
+        best_ids = max(finished, key=lambda hypothesis: hypothesis[0])[1]
+
+        return [int(i) for i in best_ids if self.dialog.is_defined(i) is not True]
+
+    # 대화 파일의 문장들로 greedy 디코딩과 빔 서치의 응답 시간을 비교한다.
+    def benchmark(self, data_path, beam_width):
+        with open(data_path, 'r', encoding="UTF8") as content_file:
+            messages = [line.strip() for line in content_file if line.strip()]
+
+        for width in (1, beam_width):
+            FLAGS.beam_width = width
+            start = time.time()
+            for msg in messages:
+                self.get_replay(msg)
+            elapsed = (time.time() - start) / len(messages)
+            print('beam_width = %d' % width, 'latency = {:.2f}ms'.format(elapsed * 1000))
+
+
+# 디코더 상태는 층마다 (c, h) 배열을 가진 LSTMStateTuple 의 튜플이다.
+def concat_states(states):
+    return tuple(layers[0]._replace(c=np.concatenate([layer.c for layer in layers]),
+                                    h=np.concatenate([layer.h for layer in layers]))
+                 for layers in zip(*states))
+
+
+def select_states(states, rows):
+    return tuple(layer._replace(c=layer.c[rows], h=layer.h[rows]) for layer in states)
+
 
 def main(_):
     print ("깨어나는 중 입니다. 잠시만 기다려주세요...\n")
 
     chatbot = ChatBot(FLAGS.voc_path, FLAGS.train_dir)
-    chatbot.run()
+    if FLAGS.beam_bench:
+        chatbot.benchmark(FLAGS.data_path, max(FLAGS.beam_width, 2))
+    else:
+        chatbot.run()
 
 if __name__ == "__main__":
     tf.app.run()
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# 학습(dialog.py), 채팅(chat.py)과 TensorFlow 없이 답변하는 inference.py 가 함께 쓰는 규칙들
+# TensorFlow 를 import 하지 않으므로 inference.py 도 가볍게 가져다 쓸 수 있고, 규칙이 한 곳에만 있으므로
+# 학습 때와 추론 때의 토큰화, 버킷, 디코딩이 어긋나지 않는다.
+
+import numpy as np
+import math
+import re
+
+
+_PAD_ID_ = 0  # 빈칸 채우는 심볼
+_STA_ID_ = 1  # 디코드 입력 시퀀스의 시작 심볼
+_EOS_ID_ = 2  # 디코드 입출력 시퀀스의 종료 심볼
+_UNK_ID_ = 3  # 사전에 없는 단어를 나타내는 심볼
+_PRE_DEFINED_ = [_PAD_ID_, _STA_ID_, _EOS_ID_, _UNK_ID_]
+
+# 공백으로 나눈 조각에서 특수문자를 따로 뽑아내는 정규식
+TOKEN_RE = re.compile("([.,!?\"':;)(])")
+
+
+def tokenizer(sentence, token_re=TOKEN_RE):
+    # 공백으로 나누고 특수문자는 따로 뽑아낸다.
+    words = []
+
+    for fragment in sentence.strip().split():
+        words.extend(token_re.split(fragment))
+
+    return [w for w in words if w]
+
+
+def tokens_to_ids(tokens, vocab_dict):
+    # 사전에 없는 단어는 index 3 (_UNK_ID_)
+    return [vocab_dict.get(t, _UNK_ID_) for t in tokens]
+
+
+def pad_input(ids, input_max):
+    # input_max 만큼 빈칸 채우는 심볼 삽입 후, 구글 방식으로 입력을 인코더에 역순으로 입력한다.
+    # 원본 리스트를 제자리에서 뒤집지 않고 복사본을 만든다.
+    return (ids + [_PAD_ID_] * (input_max - len(ids)))[::-1]
+
+
+def bucket_id(buckets, input_len, output_len=0):
+    # 질문과 (종료 심볼을 붙인) 답변이 모두 들어가는 가장 작은 버킷, 없으면 가장 큰 버킷
+    # 길이 배열을 넘기면 쌍마다의 버킷 번호 배열을 돌려준다.
+    input_len, output_len = np.broadcast_arrays(input_len, output_len)
+    bucket = np.full(input_len.shape, len(buckets) - 1)
+    for i, (enc_len, dec_len) in reversed(list(enumerate(buckets))):
+        bucket[(input_len <= enc_len) & (output_len < dec_len)] = i
+
+    return int(bucket) if bucket.ndim == 0 else bucket
+
+
+def input_len(buckets, ids):
+    # 입력이 들어가는 가장 작은 버킷의 인코더 길이로 채운다. 버킷이 없으면 입력 길이의 1.5배를 쓴다.
+    if buckets:
+        return buckets[bucket_id(buckets, len(ids))][0]
+    return int(math.ceil((len(ids) + 1) * 1.5))
+
+
+def greedy_decode(model, session, enc_input, max_decode_len):
+    # 입력은 한 번만 인코딩하고, 디코더 상태를 이어가며 매 스텝 마지막 단어 하나만 넣는다.
+    # 전체 시퀀스를 매번 다시 계산하지 않으므로 응답 시간이 응답 길이에 비례한다.
+    # model 은 Seq2Seq 또는 inference.InferenceModel (encode, decode_step)
+    dec_input = []
+
+    states = model.encode(session, [enc_input])
+    curr_id = _STA_ID_
+    for i in range(max_decode_len):
+        log_probs, states = model.decode_step(session, [curr_id], states)
+        curr_id = int(np.argmax(log_probs[0]))
+        if curr_id == _EOS_ID_:
+            break
+        elif curr_id not in _PRE_DEFINED_:
+            dec_input.append(curr_id)
+
+    return dec_input
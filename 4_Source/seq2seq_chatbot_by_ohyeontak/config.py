@@ -13,15 +13,35 @@ tf.app.flags.DEFINE_boolean("test", True, "테스트를 합니다.")
 tf.app.flags.DEFINE_boolean("data_loop", True, "작은 데이터셋을 실험해보기 위해 사용합니다.")
 tf.app.flags.DEFINE_integer("batch_size", 100, "미니 배치 크기")
 tf.app.flags.DEFINE_integer("epoch", 1000, "총 학습 반복 횟수")
+tf.app.flags.DEFINE_integer("num_sampled", 0,
+                            "0보다 크면 학습 때 그 수만큼 단어를 뽑아 sampled softmax 로 cost 를 계산합니다. (큰 어휘 사전용)")
+tf.app.flags.DEFINE_integer("prefetch", 4, "학습 중 백그라운드에서 미리 만들어두는 배치 수. 0이면 스텝마다 배치를 만듭니다.")
+tf.app.flags.DEFINE_string("buckets", "5:10,10:15,20:25,40:50",
+                           "질문:답변 길이 버킷 목록. 빈 문자열이면 버킷을 쓰지 않고 배치마다 최대 길이로 채웁니다.")
 
 tf.app.flags.DEFINE_string("data_path", "./data/chat.log", "대화 파일 위치")
 tf.app.flags.DEFINE_string("voc_path", "./data/chat.voc", "어휘 사전 파일 위치")
+tf.app.flags.DEFINE_boolean("data_cache", True, "토큰화한 대화 파일을 대화 파일 옆에 저장해두고 다음 실행부터 다시 사용합니다. 끄면 파일을 쓰지 않고 메모리에서 토큰화합니다.")
 
 
 tf.app.flags.DEFINE_boolean("voc_test", False, "어휘 사전을 테스트합니다.")
 tf.app.flags.DEFINE_boolean("voc_build", False, "주어진 대화 파일을 이용해 어휘 사전을 작성합니다.")
+tf.app.flags.DEFINE_integer("voc_min_count", 1, "어휘 사전에 넣을 단어의 최소 빈도")
+tf.app.flags.DEFINE_integer("voc_max_size", 0, "어휘 사전의 최대 단어 수 (예약 심볼 제외). 0이면 제한하지 않습니다.")
+tf.app.flags.DEFINE_integer("voc_processes", 0, "어휘 사전을 만들 때 쓰는 프로세스 수. 0이면 CPU 수만큼 씁니다.")
 
 tf.app.flags.DEFINE_integer("max_decode_len", 20, "최대 디코더 셀 크기 = 최대 답변 크기.")
+tf.app.flags.DEFINE_integer("beam_width", 1, "빔 서치 너비. 1이면 greedy 디코딩을 합니다.")
+tf.app.flags.DEFINE_float("length_penalty", 0.6, "빔 서치 길이 정규화 지수. 0이면 정규화하지 않습니다.")
+tf.app.flags.DEFINE_boolean("beam_bench", False, "대화 파일로 greedy 디코딩과 빔 서치의 응답 시간을 비교합니다.")
+
+tf.app.flags.DEFINE_string("export_path", "./export/chatbot.npz", "추론용 모델 파일 위치 (export.py, inference.py)")
+tf.app.flags.DEFINE_boolean("export_bench", False, "모델을 추출한 뒤 체크포인트와 추출한 모델의 시작 시간을 비교합니다.")
+
+tf.app.flags.DEFINE_integer("serve_port", 8000, "채팅 서버 포트")
+tf.app.flags.DEFINE_integer("serve_batch_wait", 5, "새 메시지를 한 배치로 모으기 위해 기다리는 시간 (ms)")
+tf.app.flags.DEFINE_integer("serve_max_batch", 64, "한 번에 디코딩하는 최대 대화 수")
+tf.app.flags.DEFINE_integer("serve_clients", 0, "0보다 크면 그 수만큼의 동시 사용자로 부하 테스트를 하고 종료합니다.")
 
 
 FLAGS = tf.app.flags.FLAGS
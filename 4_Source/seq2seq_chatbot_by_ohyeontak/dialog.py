@@ -3,30 +3,70 @@
 
 import tensorflow as tf
 import numpy as np
+import collections
+import multiprocessing
+import hashlib
+import os
 import re
 
+import common
 from config import FLAGS
 
 
+# 토큰화된 대화 파일: 모든 문장의 단어 id 를 이어붙인 int32 배열과 문장마다의 시작 위치(offsets)
+# 파일을 메모리 맵으로 열어두고 필요한 문장만 리스트로 꺼내므로, 큰 대화 파일도 바로 읽힌다.
+class DialogueExamples():
+
+    def __init__(self, tokens, offsets):
+        self.tokens = tokens
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+
+        return self.tokens[self.offsets[i]:self.offsets[i + 1]].tolist()
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+
 class Dialog():
     _PAD_ = "_PAD_"  # 빈칸 채우는 심볼
     _STA_ = "_STA_"  # 디코드 입력 시퀀스의 시작 심볼
     _EOS_ = "_EOS_"  # 디코드 입출력 시퀀스의 종료 심볼
     _UNK_ = "_UNK_"  # 사전에 없는 단어를 나타내는 심볼
 
-    _PAD_ID_ = 0
-    _STA_ID_ = 1
-    _EOS_ID_ = 2
-    _UNK_ID_ = 3
-    _PRE_DEFINED_ = [_PAD_ID_, _STA_ID_, _EOS_ID_, _UNK_ID_]
+    # 심볼 id 와 토큰화, 버킷 규칙은 inference.py 와 함께 쓰도록 common.py 에 있다.
+    _PAD_ID_ = common._PAD_ID_
+    _STA_ID_ = common._STA_ID_
+    _EOS_ID_ = common._EOS_ID_
+    _UNK_ID_ = common._UNK_ID_
+    _PRE_DEFINED_ = common._PRE_DEFINED_
+
+    # 공백으로 나눈 조각에서 특수문자를 따로 뽑아내는 정규식
+    _TOKEN_RE_ = common.TOKEN_RE
 
     def __init__(self):
         self.vocab_list = []
+        self.vocab_counts = []
         self.vocab_dict = {}
         self.vocab_size = 0
         self.examples = []
 
+        # [(인코더 길이, 디코더 길이), ...] 작은 버킷부터 순서대로
+        self.buckets = self.parse_buckets(FLAGS.buckets)
+        self.bucket_examples = []
+
         self._index_in_epoch = 0
+        self._index_in_bucket = []
+
+        # 패딩 낭비를 보고하기 위한 토큰 수
+        self.pad_count = 0
+        self.token_count = 0
 
     def decode(self, indices, string=False):
         tokens = [[self.vocab_list[i] for i in dec] for dec in indices]
@@ -83,21 +123,48 @@ class Dialog():
         else:
             return seq
 
+    def pad_input(self, input, input_max):
+        return common.pad_input(input, input_max)
+
     def transform(self, input, output, input_max, output_max):
-        enc_input = self.pad(input, input_max)  # max_len만큼 빈칸 채우는 심볼 삽입
+        enc_input = self.pad_input(input, input_max)
         dec_input = self.pad(output, output_max, start=True)  # 디코드 입력 시퀀스의 시작 심볼 삽입
         target = self.pad(output, output_max, eos=True)  # 디코드 입출력 시퀀스의 종료 심볼 삽입
 
-        # 구글 방식으로 입력을 인코더에 역순으로 입력한다.
-        enc_input.reverse()
+        # one-hot 으로 바꾸지 않고 단어 id 그대로 돌려준다. 임베딩은 모델 안에서 처리한다.
+        return enc_input, dec_input, target
 
-        # np.eye : 단위행렬로 변환
-        enc_input = np.eye(self.vocab_size)[enc_input]
-        dec_input = np.eye(self.vocab_size)[dec_input]
+    def parse_buckets(self, buckets):
+        # "5:10,10:15" -> [(5, 10), (10, 15)]
+        if not buckets:
+            return []
 
-        return enc_input, dec_input, target
+        return sorted(tuple(int(size) for size in bucket.split(':')) for bucket in buckets.split(','))
+
+    def bucket_id(self, input_len, output_len=0):
+        # 학습(build_buckets)과 추론(common.input_len)이 같은 버킷을 고르도록 둘 다 common.bucket_id 를 쓴다.
+        return common.bucket_id(self.buckets, input_len, output_len)
+
+    def build_buckets(self):
+        # 질문/답변 쌍을 길이에 따라 버킷에 나눈다. 버킷마다 질문 문장의 번호만 저장하고,
+        # 가장 큰 버킷보다 긴 쌍은 배치를 만들 때 버킷 크기에 맞게 자른다.
+        # data_loop 이면 현재의 답변을 다음 질문으로 하는 쌍도 함께 사용한다.
+        step = 1 if FLAGS.data_loop is True else 2
+        lengths = self.examples.lengths()
+        starts = np.arange(0, len(self.examples) - 1, step)
+        bucket = self.bucket_id(lengths[starts], lengths[starts + 1])
+
+        self.bucket_examples = [starts[bucket == i] for i in range(len(self.buckets))]
+        self._index_in_bucket = [0] * len(self.buckets)
+
+    def padding_waste(self):
+        # 지금까지 만든 배치에서 패딩 심볼이 차지한 비율
+        return self.pad_count / float(max(self.token_count, 1))
 
     def next_batch(self, batch_size):
+        if self.buckets:
+            return self.next_bucket_batch(batch_size)
+
         enc_input = []
         dec_input = []
         target = []
@@ -119,8 +186,7 @@ class Dialog():
         if FLAGS.data_loop is True:
             batch_set = batch_set + batch_set[1:] + batch_set[0:1]
 
-        # TODO: 구글처럼 버킷을 이용한 방식으로 변경 필요
-        # 간단하게 만들기 위해 구글처럼 버킷을 쓰지 않고 같은 batch_set에서 같은 size를 사용하도록 만듬
+        # 버킷을 쓰지 않을 때는 같은 batch_set에서 같은 size를 사용하도록 만듬
         max_len_input, max_len_output = self.max_len(batch_set)  # max값 사용
 
         for i in range(0, len(batch_set) - 1, 2):
@@ -131,18 +197,49 @@ class Dialog():
             dec_input.append(dec)  # 디코딩 저장
             target.append(tar)
 
-        return enc_input, dec_input, target
+        return self.to_arrays(enc_input, dec_input, target)
 
-    def tokens_to_ids(self, tokens):
-        ids = []
+    def next_bucket_batch(self, batch_size):
+        # 예제 수에 비례하는 확률로 버킷을 하나 고르고, 그 버킷의 예제들로만 배치를 만든다.
+        sizes = np.array([len(examples) for examples in self.bucket_examples], dtype=np.float64)
+        if sizes.sum() == 0:
+            raise ValueError("버킷에 들어간 질문/답변 쌍이 없습니다. 대화 데이터가 두 문장 이상인지 확인하세요. "
+                             "(문장 수: %d, 버킷: %s)" % (len(self.examples), FLAGS.buckets))
+        bucket = np.random.choice(len(sizes), p=sizes / sizes.sum())
+        examples = self.bucket_examples[bucket]
+
+        start = self._index_in_bucket[bucket]
+        if start + batch_size < len(examples):
+            self._index_in_bucket[bucket] = start + batch_size
+        else:
+            self._index_in_bucket[bucket] = 0
+
+        enc_len, dec_len = self.buckets[bucket]
+        batch_set = [(self.examples[i][:enc_len], self.examples[i + 1][:dec_len - 1])
+                     for i in examples[start:start + batch_size]]
 
-        for t in tokens:
-            if t in self.vocab_dict:
-                ids.append(self.vocab_dict[t])  # 한 문장의 index 번호를 ids 배열에 저장
-            else:
-                ids.append(self._UNK_ID_)  # 사전에 없는 단어일 경우 index 3 할당
+        # 같은 버킷 안의 예제들이므로 배치 안의 최대 길이로 채워도 낭비가 적다.
+        max_len_input = max(len(input) for input, output in batch_set)
+        max_len_output = max(len(output) for input, output in batch_set) + 1
 
-        return ids
+        enc_input, dec_input, target = zip(*[self.transform(input, output, max_len_input, max_len_output)
+                                             for input, output in batch_set])
+
+        return self.to_arrays(enc_input, dec_input, target)
+
+    def to_arrays(self, enc_input, dec_input, target):
+        # [batch, time] 크기의 정수 배열로 바꾸고, 패딩 낭비를 집계한다.
+        enc_input = np.array(enc_input, dtype=np.int32)
+        dec_input = np.array(dec_input, dtype=np.int32)
+        target = np.array(target, dtype=np.int64)
+
+        self.token_count += enc_input.size + target.size
+        self.pad_count += int(np.sum(enc_input == self._PAD_ID_) + np.sum(target == self._PAD_ID_))
+
+        return enc_input, dec_input, target
+
+    def tokens_to_ids(self, tokens):
+        return common.tokens_to_ids(tokens, self.vocab_dict)
 
     def ids_to_tokens(self, ids):
         tokens = []
@@ -153,48 +250,152 @@ class Dialog():
         return tokens
 
     def load_dialogue(self, data_path):
-        self.examples = []
-
-        # 한 문장씩 읽어서 할당된 단어의 인덱스를 저장
-        with open(data_path, 'r', encoding="UTF8") as content_file:
-            for line in content_file:
-                tokens = self.tokenizer(line.strip())
-                ids = self.tokens_to_ids(tokens)
-                self.examples.append(ids)
+        # 대화 파일과 어휘 사전이 같으면 이전에 토큰화해둔 파일을 메모리 맵으로 연다.
+        # data_cache 가 꺼져 있으면 파일을 쓰지 않고 메모리에서 토큰화한다.
+        if FLAGS.data_cache:
+            cache_path = self.cache_path(data_path)
+            if not os.path.exists(cache_path + '.offsets'):
+                self.build_cache(data_path, cache_path)
+
+            offsets = self.memmap(cache_path + '.offsets', np.int64)
+            self.examples = DialogueExamples(self.memmap(cache_path + '.tokens', np.int32), offsets)
+        else:
+            chunks = list(self.tokenize_chunks(data_path))
+            offsets = np.cumsum([0] + [n for ids, lengths in chunks for n in lengths], dtype=np.int64)
+            self.examples = DialogueExamples(np.concatenate([ids for ids, lengths in chunks]), offsets)
 
-    def tokenizer(self, sentence):
-        # 공백으로 나누고 특수문자는 따로 뽑아낸다.
-        words = []
-        _TOKEN_RE_ = re.compile("([.,!?\"':;)(])")
+        if self.buckets:
+            self.build_buckets()
 
-        for fragment in sentence.strip().split():
-            words.extend(_TOKEN_RE_.split(fragment))
+    def cache_path(self, data_path):
+        # 대화 파일(크기, 수정 시각), 어휘 사전, 토크나이저가 바뀌면 키도 바뀐다.
+        # 파일 내용 전체를 해시하면 큰 파일에서는 그것만으로 몇 초가 걸리므로 파일 정보만 쓴다.
+        stat = os.stat(data_path)
+        key = hashlib.sha1()
+        key.update(('%d:%d:%s\n' % (stat.st_size, stat.st_mtime_ns, self._TOKEN_RE_.pattern)).encode('utf-8'))
+        key.update('\n'.join(map(str, self.vocab_list)).encode('utf-8'))
 
-        return [w for w in words if w]
+        return '%s.%s' % (data_path, key.hexdigest()[:16])
 
-    def build_vocab(self, data_path, vocab_path):
+    def tokenize_chunks(self, data_path, chunk_lines=100000):
+        # 한 문장씩 읽어서 chunk_lines 문장마다 (이어붙인 단어 인덱스 배열, 문장 길이 리스트)를 돌려준다.
         with open(data_path, 'r', encoding="UTF8") as content_file:
-            content = content_file.read()
-            words = self.tokenizer(content)
-            words = list(set(words))
+            ids = []
+            lengths = []
+            for line in content_file:
+                sentence = self.tokens_to_ids(self.tokenizer(line.strip()))
+                ids.extend(sentence)
+                lengths.append(len(sentence))
+
+                if len(lengths) == chunk_lines:
+                    yield np.array(ids, dtype=np.int32), lengths
+                    ids = []
+                    lengths = []
+
+            yield np.array(ids, dtype=np.int32), lengths
+
+    def build_cache(self, data_path, cache_path, chunk_lines=100000):
+        # 할당된 단어의 인덱스를 chunk_lines 문장마다 파일에 이어 쓴다.
+        # 다 쓴 뒤에 이름을 바꾸므로 중간에 멈춰도 깨진 파일이 남지 않는다.
+        lengths = [0]
+        with open(cache_path + '.tokens.tmp', 'wb') as tokens_file:
+            for ids, chunk_lengths in self.tokenize_chunks(data_path, chunk_lines):
+                ids.tofile(tokens_file)
+                lengths.extend(chunk_lengths)
+
+        np.cumsum(lengths, dtype=np.int64).tofile(cache_path + '.offsets.tmp')
+        os.replace(cache_path + '.tokens.tmp', cache_path + '.tokens')
+        os.replace(cache_path + '.offsets.tmp', cache_path + '.offsets')
+
+        self.remove_old_caches(data_path, cache_path)
+
+    def remove_old_caches(self, data_path, cache_path):
+        # 대화 파일이 바뀔 때마다 새 키로 캐시를 만들므로, 같은 대화 파일의 예전 캐시 파일은 지운다.
+        # cache_path 와 같은 모양(<대화 파일>.<16자리 키>.tokens/.offsets)의 이름만 지운다.
+        directory = os.path.dirname(os.path.abspath(data_path))
+        pattern = re.compile(re.escape(os.path.basename(data_path)) + r'\.[0-9a-f]{16}\.(tokens|offsets)$')
+        keep = os.path.basename(cache_path)
+
+        for name in os.listdir(directory):
+            if pattern.match(name) and not name.startswith(keep + '.'):
+                os.remove(os.path.join(directory, name))
+
+    def memmap(self, path, dtype):
+        # 빈 파일은 메모리 맵으로 열 수 없다.
+        if os.path.getsize(path) == 0:
+            return np.zeros(0, dtype=dtype)
+
+        return np.memmap(path, dtype=dtype, mode='r')
+
+    @classmethod
+    def tokenizer(cls, sentence):
+        return common.tokenizer(sentence, cls._TOKEN_RE_)
+
+    def build_vocab(self, data_path, vocab_path, min_count=1, max_size=0, processes=None):
+        # 대화 파일을 바이트 구간으로 나눠 프로세스마다 단어 빈도를 세고 합친다.
+        # 파일 전체를 메모리에 올리지 않으며, 구간 수를 프로세스 수보다 많게 해서 일을 고르게 나눈다.
+        processes = processes or multiprocessing.cpu_count()
+        size = os.path.getsize(data_path)
+        n_chunks = max(1, min(processes * 4, size // (1 << 20) + 1))
+        bounds = [size * i // n_chunks for i in range(n_chunks + 1)]
+        chunks = [(data_path, start, end) for start, end in zip(bounds[:-1], bounds[1:])]
+
+        counts = collections.Counter()
+        if processes > 1 and n_chunks > 1:
+            with multiprocessing.Pool(processes) as pool:
+                for chunk_counts in pool.imap_unordered(count_tokens, chunks):
+                    counts.update(chunk_counts)
+        else:
+            for chunk in chunks:
+                counts.update(count_tokens(chunk))
 
-        with open(vocab_path, 'w') as vocab_file:
-            for w in words:
-                vocab_file.write(w + '\n')
+        # 빈도가 높은 단어부터 작은 id 를 받도록 정렬하고, min_count 미만인 단어와 max_size 를 넘는 단어는 버린다.
+        words = sorted((item for item in counts.items() if item[1] >= min_count), key=lambda item: (-item[1], item[0]))
+        if max_size > 0:
+            words = words[:max_size]
+
+        with open(vocab_path, 'w', encoding="UTF8") as vocab_file:
+            for w, count in words:
+                vocab_file.write('%s\t%d\n' % (w, count))
+
+        return len(words), len(counts)
 
     def load_vocab(self, vocab_path):
         self.vocab_list = self._PRE_DEFINED_ + []
+        self.vocab_counts = [0] * len(self._PRE_DEFINED_)
 
-        # voc 파일을 읽어 vocabulary list 생성
+        # voc 파일을 읽어 vocabulary list 생성. 한 줄에 "단어<탭>빈도" 이며, 빈도가 없는 예전 형식도 읽는다.
         with open(vocab_path, 'r', encoding="UTF8") as vocab_file:
             for line in vocab_file:
-                self.vocab_list.append(line.strip())
+                fields = line.strip().split('\t')
+                self.vocab_list.append(fields[0])
+                self.vocab_counts.append(int(fields[1]) if len(fields) > 1 else 0)
 
         # {'_PAD_': 0, '_STA_': 1, '_EOS_': 2, '_UNK_': 3, 'Hello': 4, 'World': 5, ...}
         self.vocab_dict = {n: i for i, n in enumerate(self.vocab_list)}  # 어절마다 index 번호 할당
         self.vocab_size = len(self.vocab_list)  # vocab_size 저장
 
 
+# 대화 파일의 [start, end) 바이트 구간에서 시작하는 줄들의 단어 빈도를 센다. (프로세스 풀에서 실행)
+def count_tokens(chunk):
+    data_path, start, end = chunk
+    counts = collections.Counter()
+
+    with open(data_path, 'rb') as content_file:
+        # 구간이 줄 중간에서 시작하면 그 줄은 앞 구간의 몫이므로 다음 줄부터 센다.
+        if start > 0:
+            content_file.seek(start - 1)
+            content_file.readline()
+
+        while content_file.tell() < end:
+            line = content_file.readline()
+            if not line:
+                break
+            counts.update(Dialog.tokenizer(line.decode('utf-8')))
+
+    return counts
+
+
 def main(_):
     dialog = Dialog()
 
@@ -208,9 +409,17 @@ def main(_):
         enc, dec, target = dialog.next_batch(10)
         print(target)
 
+        if dialog.buckets:
+            print("버킷별 예제 수:", [(bucket, len(examples))
+                                    for bucket, examples in zip(dialog.buckets, dialog.bucket_examples)])
+        print("패딩 비율: {:.1%}".format(dialog.padding_waste()))
+
     elif FLAGS.data_path and FLAGS.voc_build:
         print("다음 데이터에서 어휘 사전을 생성합니다.", FLAGS.data_path)
-        dialog.build_vocab(FLAGS.data_path, FLAGS.voc_path)
+        n_words, n_seen = dialog.build_vocab(FLAGS.data_path, FLAGS.voc_path,
+                                             min_count=FLAGS.voc_min_count, max_size=FLAGS.voc_max_size,
+                                             processes=FLAGS.voc_processes)
+        print("전체 %d 단어 중 %d 단어를 저장했습니다." % (n_seen, n_words), FLAGS.voc_path)
 
     elif FLAGS.voc_test:
         dialog.load_vocab(FLAGS.voc_path)
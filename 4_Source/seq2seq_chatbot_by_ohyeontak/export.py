@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+# 학습한 체크포인트에서 추론에 필요한 변수만 꺼내 inference.py 가 읽는 모델 파일 하나로 저장한다.
+# Adam 슬롯 같은 학습용 변수는 빼고, 어휘 사전과 버킷 설정을 함께 넣는다.
+
+import tensorflow as tf
+import numpy as np
+import subprocess
+import time
+import sys
+import os
+
+import inference
+from config import FLAGS
+from model import Seq2Seq
+from dialog import Dialog
+
+
+# 체크포인트의 변수 이름. Tensorflow 버전에 따라 LSTM 변수 이름이 weights/biases 또는 kernel/bias 이다.
+def cell_variable(names, scope, layer, kinds):
+    for kind in kinds:
+        name = '%s/rnn/multi_rnn_cell/cell_%d/basic_lstm_cell/%s' % (scope, layer, kind)
+        if name in names:
+            return name
+
+
+def checkpoint_arrays(checkpoint_path):
+    reader = tf.train.NewCheckpointReader(checkpoint_path)
+    names = reader.get_variable_to_shape_map()
+
+    arrays = {'embedding': reader.get_tensor('embedding'),
+              'weights': reader.get_tensor('weights'),  # [vocab_size, n_hidden]
+              'bias': reader.get_tensor('bias')}
+
+    n_layers = 0
+    while cell_variable(names, 'encode', n_layers, ('kernel', 'weights')):
+        for scope in ('encode', 'decode'):
+            arrays['%s_kernel_%d' % (scope, n_layers)] = \
+                reader.get_tensor(cell_variable(names, scope, n_layers, ('kernel', 'weights')))
+            arrays['%s_bias_%d' % (scope, n_layers)] = \
+                reader.get_tensor(cell_variable(names, scope, n_layers, ('bias', 'biases')))
+        n_layers += 1
+
+    arrays['n_layers'] = np.array(n_layers)
+
+    return arrays
+
+
+def export(dialog, checkpoint_path, export_path):
+    arrays = checkpoint_arrays(checkpoint_path)
+
+    # 예약 심볼은 이름으로 저장한다. 어휘 사전은 줄바꿈으로 이은 utf-8 바이트 하나로 넣는다.
+    words = [dialog._PAD_, dialog._STA_, dialog._EOS_, dialog._UNK_] + dialog.vocab_list[len(dialog._PRE_DEFINED_):]
+    arrays['vocab'] = np.frombuffer('\n'.join(words).encode('utf-8'), dtype=np.uint8)
+    arrays['token_pattern'] = np.array(dialog._TOKEN_RE_.pattern)
+    arrays['buckets'] = np.array(dialog.buckets, dtype=np.int32).reshape(-1, 2)
+    arrays['max_decode_len'] = np.array(FLAGS.max_decode_len)
+
+    if os.path.dirname(export_path):
+        os.makedirs(os.path.dirname(export_path), exist_ok=True)
+    np.savez(export_path, **arrays)
+
+
+# 추출한 파일의 numpy 모델(inference.py)과 체크포인트의 Seq2Seq 를 같은 입력으로 인코딩하고 한 스텝 디코딩해서 비교한다.
+# numpy 로 옮긴 BasicLSTMCell 의 게이트 순서(i, j, f, o)나 forget_bias 가 체크포인트와 다르면 이상한 답변이 나오기 전에
+# 여기서 바로 드러난다.
+def check_parity(dialog, checkpoint_path, export_path, msg="안녕", tolerance=1e-4):
+    bot = inference.load(export_path)
+    enc_input = bot.encode_input(msg)
+
+    model = Seq2Seq(dialog.vocab_size)
+    with tf.Session() as sess:
+        model.saver.restore(sess, checkpoint_path)
+        states = model.encode(sess, [enc_input])
+        log_probs, next_states = model.decode_step(sess, [dialog._STA_ID_], states)
+
+    np_states = bot.model.encode(None, [enc_input])
+    np_log_probs, np_next_states = bot.model.decode_step(None, [dialog._STA_ID_], np_states)
+
+    error = np.abs(log_probs - np_log_probs).max()
+    for layer, np_layer in zip(next_states, np_next_states):
+        error = max(error, np.abs(layer.c - np_layer.c).max(), np.abs(layer.h - np_layer.h).max())
+    if error > tolerance:
+        raise ValueError("추출한 모델이 체크포인트와 다른 값을 냅니다. (최대 차이 %g)" % error)
+
+    return error
+
+
+# 새 프로세스에서 import 부터 첫 답변까지 걸리는 시간을 잰다.
+def benchmark(export_path, msg):
+    starts = [('checkpoint', 'from chat import ChatBot; ChatBot(%r, %r).get_replay(%r)'
+               % (FLAGS.voc_path, FLAGS.train_dir, msg)),
+              ('export', 'import inference; inference.load(%r).get_replay(%r)' % (export_path, msg))]
+
+    for name, code in starts:
+        start = time.time()
+        subprocess.check_call([sys.executable, '-c', code])
+        print(name, 'startup = {:.2f}s'.format(time.time() - start))
+
+
+def main(_):
+    dialog = Dialog()
+    dialog.load_vocab(FLAGS.voc_path)
+
+    ckpt = tf.train.get_checkpoint_state(FLAGS.train_dir)
+    export(dialog, ckpt.model_checkpoint_path, FLAGS.export_path)
+    print("추론용 모델을 저장했습니다.", FLAGS.export_path)
+
+    error = check_parity(dialog, ckpt.model_checkpoint_path, FLAGS.export_path)
+    print("체크포인트와의 한 스텝 최대 차이: %g" % error)
+
+    if FLAGS.export_bench:
+        benchmark(FLAGS.export_path, "안녕")
+
+if __name__ == "__main__":
+    tf.app.run()
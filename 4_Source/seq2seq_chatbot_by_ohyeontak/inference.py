@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+# export.py 로 추출한 모델 파일 하나로 TensorFlow 없이 numpy 만으로 답변하는 가벼운 챗봇
+# 학습 그래프와 Adam 변수를 만들지 않고 TensorFlow 도 import 하지 않으므로 바로 시작한다.
+# 토큰화, 버킷, greedy 디코딩은 chat.py 와 같은 common.py 의 함수를 쓴다.
+
+import numpy as np
+import collections
+import re
+import sys
+
+import common
+
+
+# model.py 의 디코더 상태와 같은 모양: 층마다 (c, h)
+LSTMStateTuple = collections.namedtuple('LSTMStateTuple', ('c', 'h'))
+
+
+def sigmoid(x):
+    return 1.0 / (1.0 + np.exp(-x))
+
+
+def log_softmax(logits):
+    logits = logits - logits.max(axis=1, keepdims=True)
+    return logits - np.log(np.exp(logits).sum(axis=1, keepdims=True))
+
+
+# Seq2Seq 의 추론 부분 (인코더와 한 스텝 디코더)을 numpy 로 구현한다.
+# encode, decode_step 은 Seq2Seq 와 같은 모양의 값을 돌려주며, session 인자는 쓰지 않는다.
+class InferenceModel:
+
+    def __init__(self, arrays):
+        self.embedding = arrays['embedding']
+        self.weights = arrays['weights']
+        self.bias = arrays['bias']
+
+        n_layers = int(arrays['n_layers'])
+        self.encoder = [(arrays['encode_kernel_%d' % i], arrays['encode_bias_%d' % i]) for i in range(n_layers)]
+        self.decoder = [(arrays['decode_kernel_%d' % i], arrays['decode_bias_%d' % i]) for i in range(n_layers)]
+
+    # tf.contrib.rnn.BasicLSTMCell (게이트 순서 i, j, f, o, forget_bias=1.0) 을 층마다 한 스텝 실행한다.
+    # 체크포인트와 같은 값을 내는지는 export.py 의 check_parity 가 모델을 추출할 때 확인한다.
+    def cell_step(self, layers, x, states):
+        next_states = []
+        for (kernel, bias), state in zip(layers, states):
+            i, j, f, o = np.split(np.concatenate([x, state.h], axis=1).dot(kernel) + bias, 4, axis=1)
+            c = state.c * sigmoid(f + 1.0) + sigmoid(i) * np.tanh(j)
+            x = np.tanh(c) * sigmoid(o)
+            next_states.append(LSTMStateTuple(c, x))
+
+        return x, tuple(next_states)
+
+    def encode(self, session, enc_input):
+        enc_input = np.asarray(enc_input)
+        zeros = np.zeros((len(enc_input), self.embedding.shape[1]), dtype=self.embedding.dtype)
+        states = tuple(LSTMStateTuple(zeros, zeros) for _ in self.encoder)
+
+        for t in range(enc_input.shape[1]):
+            _, states = self.cell_step(self.encoder, self.embedding[enc_input[:, t]], states)
+
+        return states
+
+    def decode_step(self, session, step_input, states):
+        outputs, states = self.cell_step(self.decoder, self.embedding[np.asarray(step_input)], states)
+
+        # 출력층 가중치는 model.py 와 같이 [vocab_size, n_hidden] 모양이다.
+        return log_softmax(outputs.dot(self.weights.T) + self.bias), states
+
+
+class InferenceChatBot:
+
+    def __init__(self, model_path):
+        arrays = np.load(model_path)
+        self.model = InferenceModel(arrays)
+
+        # 어휘 사전은 줄바꿈으로 이은 utf-8 바이트로 저장되어 있다.
+        self.vocab_list = arrays['vocab'].tobytes().decode('utf-8').split('\n')
+        self.vocab_dict = {n: i for i, n in enumerate(self.vocab_list) if i >= len(common._PRE_DEFINED_)}
+        self.token_re = re.compile(str(arrays['token_pattern']))
+        self.buckets = [tuple(bucket) for bucket in arrays['buckets'].tolist()]
+        self.max_decode_len = int(arrays['max_decode_len'])
+
+    def run(self):
+        sys.stdout.write("> ")
+        sys.stdout.flush()
+        line = sys.stdin.readline()
+
+        while line:
+            print (self.get_replay(line.strip()))
+
+            sys.stdout.write("\n> ")
+            sys.stdout.flush()
+
+            line = sys.stdin.readline()
+
+    def encode_input(self, msg):
+        enc_input = common.tokens_to_ids(common.tokenizer(msg, self.token_re), self.vocab_dict)
+        return common.pad_input(enc_input, common.input_len(self.buckets, enc_input))
+
+    # ChatBot.get_replay 의 greedy 디코딩과 같다.
+    def get_replay(self, msg):
+        dec_input = common.greedy_decode(self.model, None, self.encode_input(msg), self.max_decode_len)
+
+        return ' '.join(self.vocab_list[i] for i in dec_input).strip()
+
+
+def load(model_path):
+    return InferenceChatBot(model_path)
+
+
+if __name__ == "__main__":
+    # python inference.py ./export/chatbot.npz
+    load(sys.argv[1] if len(sys.argv) > 1 else './export/chatbot.npz').run()
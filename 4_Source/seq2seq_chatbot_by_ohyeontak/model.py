@@ -7,22 +7,31 @@ import tensorflow as tf
 # Seq2Seq 기본 클래스
 class Seq2Seq:
     logits = None
-    outputs = None
     cost = None
     train_op = None
 
-    def __init__(self, vocab_size, n_hidden=128, n_layers=3):
+    def __init__(self, vocab_size, n_hidden=128, n_layers=3, num_sampled=0):
         self.learning_late = 0.001
+        self.num_sampled = num_sampled
 
         self.vocab_size = vocab_size
         self.n_hidden = n_hidden
         self.n_layers = n_layers
 
-        self.enc_input = tf.placeholder(tf.float32, [None, None, self.vocab_size])
-        self.dec_input = tf.placeholder(tf.float32, [None, None, self.vocab_size])
+        # one-hot 행렬 대신 단어 id 를 [batch, time] 형태로 입력받습니다.
+        self.enc_input = tf.placeholder(tf.int32, [None, None])
+        self.dec_input = tf.placeholder(tf.int32, [None, None])
         self.targets = tf.placeholder(tf.int64, [None, None])
 
-        self.weights = tf.Variable(tf.ones([self.n_hidden, self.vocab_size]), name="weights")
+        # 학습 때만 dropout 을 적용하고, 추론 때는 기본값 1.0 으로 모든 출력을 사용한다.
+        self.output_keep_prob = 0.5
+        self.keep_prob = tf.placeholder_with_default(1.0, [])
+
+        # 단어 id 를 n_hidden 크기의 벡터로 바꾸는 임베딩 (인코더와 디코더가 같이 사용)
+        self.embedding = tf.Variable(tf.random_uniform([self.vocab_size, self.n_hidden], -1.0, 1.0),
+                                     name="embedding")
+        # 출력층 가중치는 sampled_softmax_loss 가 받는 [vocab_size, n_hidden] 모양으로 두고, logits 는 전치 곱으로 구한다.
+        self.weights = tf.Variable(tf.ones([self.vocab_size, self.n_hidden]), name="weights")
         self.bias = tf.Variable(tf.zeros([self.vocab_size]), name="bias")
         self.global_step = tf.Variable(0, trainable=False, name="global_step")
 
@@ -32,25 +41,44 @@ class Seq2Seq:
 
     # model 생성
     def build_model(self):
-        # enc_input, dec_input 대해서 transpose를 수행
-        self.enc_input = tf.transpose(self.enc_input, [1, 0, 2])
-        self.dec_input = tf.transpose(self.dec_input, [1, 0, 2])
+        # enc_input, dec_input 의 단어 id 를 임베딩 벡터로 변환: [batch, time] -> [batch, time, n_hidden]
+        enc_input = tf.nn.embedding_lookup(self.embedding, self.enc_input)
+        dec_input = tf.nn.embedding_lookup(self.embedding, self.dec_input)
 
         # Cell 생성 후 저장
         enc_cell, dec_cell = self.build_cells()
 
         # 모든 Tensorflow의 RNN 함수들은 Cell을 인자로 받음
+        # 디코더는 인코더의 마지막 상태에서 시작한다.
         with tf.variable_scope('encode'):
-            outputs, enc_states = tf.nn.dynamic_rnn(enc_cell, self.enc_input, dtype=tf.float32)
+            outputs, self.enc_states = tf.nn.dynamic_rnn(enc_cell, enc_input, dtype=tf.float32)
         with tf.variable_scope('decode'):
-            outputs, dec_states = tf.nn.dynamic_rnn(dec_cell, self.dec_input, dtype=tf.float32)
+            outputs, dec_states = tf.nn.dynamic_rnn(dec_cell, dec_input, initial_state=self.enc_states,
+                                                    dtype=tf.float32)
 
         self.logits, self.cost, self.train_op = self.build_ops(outputs, self.targets)
 
-        self.outputs = tf.argmax(self.logits, 2)
+        self.build_step(dec_cell)
+
+    # 추론용 한 스텝 디코더: 이전 상태와 마지막 단어 하나만 받아 다음 단어와 새 상태를 돌려준다.
+    # 학습 그래프와 같은 'decode' 스코프를 재사용하므로 변수를 공유한다.
+    def build_step(self, dec_cell):
+        self.step_input = tf.placeholder(tf.int32, [None])
+        self.step_states = tuple(tf.contrib.rnn.LSTMStateTuple(tf.placeholder(tf.float32, [None, self.n_hidden]),
+                                                               tf.placeholder(tf.float32, [None, self.n_hidden]))
+                                 for _ in range(self.n_layers))
+
+        step_input = tf.nn.embedding_lookup(self.embedding, self.step_input)
+        with tf.variable_scope('decode', reuse=True):
+            outputs, self.step_next_states = tf.nn.dynamic_rnn(dec_cell, tf.expand_dims(step_input, 1),
+                                                               initial_state=self.step_states,
+                                                               dtype=tf.float32)
+
+        step_logits = tf.matmul(outputs[:, 0, :], self.weights, transpose_b=True) + self.bias
+        self.step_log_probs = tf.nn.log_softmax(step_logits)
 
     # cell 생성
-    def build_cells(self, output_keep_prob=0.5):
+    def build_cells(self):
         # tensorflow 1.0.1버전 수정 (오연택)
 
         # LSTM cell
@@ -58,14 +86,14 @@ class Seq2Seq:
 
         # RNN cell의 입력과 출력 연결에 대해 dropout 기능을 추가해주는 wrapper
         # 다중 레이어와 과적합 방지를 위한 Dropout 기법을 사용
-        enc_cell = tf.contrib.rnn.DropoutWrapper(enc_cell, output_keep_prob=output_keep_prob)
+        enc_cell = tf.contrib.rnn.DropoutWrapper(enc_cell, output_keep_prob=self.keep_prob)
 
         # 여러개의 RNN cell을 연결하여, Multi-layer cell로 구성해주는 wrapper입니다.
         enc_cell = tf.contrib.rnn.MultiRNNCell([enc_cell] * self.n_layers)
 
-        # decoding cell
-        dec_cell = tf.contrib.rnn.BasicRNNCell(self.n_hidden)
-        dec_cell = tf.contrib.rnn.DropoutWrapper(dec_cell, output_keep_prob=output_keep_prob)
+        # decoding cell: 인코더 상태를 그대로 이어받도록 같은 구조의 LSTM 을 쓴다.
+        dec_cell = tf.contrib.rnn.BasicLSTMCell(self.n_hidden)
+        dec_cell = tf.contrib.rnn.DropoutWrapper(dec_cell, output_keep_prob=self.keep_prob)
         dec_cell = tf.contrib.rnn.MultiRNNCell([dec_cell] * self.n_layers)
 
         # 생성된 cell retrun
@@ -77,14 +105,23 @@ class Seq2Seq:
         outputs = tf.reshape(outputs, [-1, self.n_hidden])
 
         # logits 는 one-hot 인코딩을 사용합니다.
-        logits = tf.matmul(outputs, self.weights) + self.bias
+        logits = tf.matmul(outputs, self.weights, transpose_b=True) + self.bias
         logits = tf.reshape(logits, [-1, time_steps, self.vocab_size])
 
         ## Define loss and optimizer
-        # Tensorflow 1.0.0에서는 파라미터 순서가 변경
-        cost = tf.reduce_mean(
-            tf.nn.sparse_softmax_cross_entropy_with_logits(logits=logits,
-                                                           labels=targets))  # Softmax loss
+        if 0 < self.num_sampled < self.vocab_size:
+            # 학습 때는 전체 어휘 대신 num_sampled 개의 단어만 뽑아 softmax 를 근사한다. (Sampled softmax loss)
+            # 어휘 사전이 빈도 순으로 정렬되어 있으므로 기본 log-uniform 샘플러가 단어 빈도 분포에 잘 맞는다.
+            # 추론에 쓰는 logits 는 그대로 전체 어휘에 대해 계산한다.
+            cost = tf.reduce_mean(
+                tf.nn.sampled_softmax_loss(weights=self.weights, biases=self.bias,
+                                           labels=tf.reshape(targets, [-1, 1]), inputs=outputs,
+                                           num_sampled=self.num_sampled, num_classes=self.vocab_size))
+        else:
+            # Tensorflow 1.0.0에서는 파라미터 순서가 변경
+            cost = tf.reduce_mean(
+                tf.nn.sparse_softmax_cross_entropy_with_logits(logits=logits,
+                                                               labels=targets))  # Softmax loss
         # AdamOptimizer
         train_op = tf.train.AdamOptimizer(learning_rate=self.learning_late).minimize(cost, global_step=self.global_step)
 
@@ -97,12 +134,21 @@ class Seq2Seq:
         return session.run([self.train_op, self.cost],
                            feed_dict={self.enc_input: enc_input,
                                       self.dec_input: dec_input,
-                                      self.targets: targets})
+                                      self.targets: targets,
+                                      self.keep_prob: self.output_keep_prob})
 
-    def predict(self, session, enc_input, dec_input):
-        return session.run(self.outputs,
-                           feed_dict={self.enc_input: enc_input,
-                                      self.dec_input: dec_input})
+    # 입력을 한 번만 인코딩해서 디코더의 첫 상태를 돌려준다.
+    def encode(self, session, enc_input):
+        return session.run(self.enc_states, feed_dict={self.enc_input: enc_input})
+
+    # 단어 하나씩 디코딩: 각 문장의 마지막 단어와 이전 상태를 넣고 (log 확률, 새 상태)를 돌려준다.
+    def decode_step(self, session, step_input, states):
+        feed_dict = {self.step_input: step_input}
+        for placeholder, state in zip(self.step_states, states):
+            feed_dict[placeholder.c] = state.c
+            feed_dict[placeholder.h] = state.h
+
+        return session.run([self.step_log_probs, self.step_next_states], feed_dict=feed_dict)
 
     def write_logs(self, session, writer, enc_input, dec_input, targets):
         merged = tf.summary.merge_all()
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+
+import tensorflow as tf
+import numpy as np
+import collections
+import threading
+import queue
+import time
+import json
+import urllib.request
+
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from config import FLAGS
+from chat import ChatBot, concat_states, select_states
+
+
+# 응답 지연 시간(p50/p99)과 처리량 카운터
+class ServingStats:
+
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=window)  # 최근 응답들의 지연 시간 (초)
+        self.started = time.time()
+        self.replies = 0
+        self.tokens = 0
+        self.steps = 0
+        self.rows = 0
+
+    def record(self, latency, tokens):
+        with self.lock:
+            self.latencies.append(latency)
+            self.replies += 1
+            self.tokens += tokens
+
+    def record_step(self, rows):
+        with self.lock:
+            self.steps += 1
+            self.rows += rows
+
+    def snapshot(self):
+        with self.lock:
+            elapsed = max(time.time() - self.started, 1e-9)
+            latencies = np.array(self.latencies) * 1000
+
+            return {'replies': self.replies,
+                    'tokens': self.tokens,
+                    'p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else 0.0,
+                    'p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else 0.0,
+                    'replies_per_sec': self.replies / elapsed,
+                    'tokens_per_sec': self.tokens / elapsed,
+                    'mean_batch': self.rows / float(self.steps) if self.steps else 0.0}
+
+
+# 대기 중인 메시지 하나와 지금까지 만든 답변
+class ChatRequest:
+
+    def __init__(self, enc_input):
+        self.enc_input = enc_input
+        self.reply = []
+        self.steps = 0
+        self.future = Future()
+        self.started = time.time()
+
+
+# 여러 사용자의 메시지를 모아 한 배치로 인코딩하고, 진행 중인 대화를 모두 한 스텝씩 함께 디코딩한다.
+# 끝난 대화는 배치에서 빠지고, 새로 들어온 메시지는 다음 스텝부터 배치에 합류한다.
+class ChatServer:
+
+    def __init__(self, chatbot, batch_wait=5, max_batch=64):
+        self.chatbot = chatbot
+        self.dialog = chatbot.dialog
+        self.model = chatbot.model
+        self.sess = chatbot.sess
+
+        self.batch_wait = batch_wait / 1000.0
+        self.max_batch = max_batch
+        self.pending = queue.Queue()
+        self.stats = ServingStats()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    # 메시지를 큐에 넣고 답변이 담길 Future 를 돌려준다. 여러 스레드에서 호출해도 된다.
+    def submit(self, msg):
+        enc_input = self.dialog.tokens_to_ids(self.dialog.tokenizer(msg))
+        request = ChatRequest(self.dialog.pad_input(enc_input, self.chatbot.input_len(enc_input)))
+        self.pending.put(request)
+        return request.future
+
+    def get_replay(self, msg):
+        return self.submit(msg).result()
+
+    # 진행 중인 대화가 없으면 첫 메시지를 기다린 뒤 batch_wait 동안 더 모으고,
+    # 디코딩 중이면 기다리지 않고 이미 들어온 메시지만 가져온다.
+    def collect(self, room, block):
+        requests = []
+        if room <= 0:
+            return requests
+
+        if block:
+            try:
+                requests.append(self.pending.get(timeout=0.1))
+            except queue.Empty:
+                return requests
+            deadline = time.time() + self.batch_wait
+            while len(requests) < room:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    requests.append(self.pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+        else:
+            while len(requests) < room:
+                try:
+                    requests.append(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+
+        return requests
+
+    # 인코더 길이가 같은 메시지끼리 한 번에 인코딩한다. 버킷을 쓰면 버킷 수만큼만 session.run 이 실행된다.
+    def encode(self, requests):
+        groups = collections.OrderedDict()
+        for request in requests:
+            groups.setdefault(len(request.enc_input), []).append(request)
+
+        ordered, states = [], []
+        for group in groups.values():
+            ordered.extend(group)
+            states.append(self.model.encode(self.sess, [request.enc_input for request in group]))
+
+        return ordered, concat_states(states)
+
+    def loop(self):
+        active = []
+        states = None
+        curr_ids = np.zeros(0, dtype=np.int32)
+
+        while not self.stopped.is_set():
+            requests = self.collect(self.max_batch - len(active), block=not active)
+            try:
+                active, states, curr_ids = self.step(active, states, curr_ids, requests)
+            except Exception as e:
+                # 배치를 처리하다 오류가 나면 이 배치의 대화들에 오류를 돌려주고, 빈 배치로 계속 서비스한다.
+                for request in active + requests:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                active, states, curr_ids = [], None, np.zeros(0, dtype=np.int32)
+
+    # 새 메시지를 배치에 넣고 진행 중인 대화를 모두 한 스텝 디코딩한다. 끝나지 않은 대화와 그 상태를 돌려준다.
+    def step(self, active, states, curr_ids, requests):
+        if requests:
+            requests, new_states = self.encode(requests)
+            active = active + requests
+            states = new_states if states is None else concat_states([states, new_states])
+            curr_ids = np.concatenate([curr_ids, np.full(len(requests), self.dialog._STA_ID_, dtype=np.int32)])
+
+        if not active:
+            return active, states, curr_ids
+
+        log_probs, states = self.model.decode_step(self.sess, curr_ids, states)
+        curr_ids = np.argmax(log_probs, 1).astype(np.int32)
+        self.stats.record_step(len(active))
+
+        # ChatBot.get_replay 와 같은 규칙으로 답변을 만든다.
+        keep = []
+        for row, request in enumerate(active):
+            curr_id = int(curr_ids[row])
+            request.steps += 1
+            if self.dialog.is_eos(curr_id):
+                self.finish(request)
+                continue
+            elif self.dialog.is_defined(curr_id) is not True:
+                request.reply.append(curr_id)
+
+            if request.steps >= FLAGS.max_decode_len:
+                self.finish(request)
+            else:
+                keep.append(row)
+
+        # 끝난 대화를 배치에서 제거한다.
+        if len(keep) < len(active):
+            active = [active[row] for row in keep]
+            states = select_states(states, keep) if active else None
+            curr_ids = curr_ids[keep]
+
+        return active, states, curr_ids
+
+    def finish(self, request):
+        self.stats.record(time.time() - request.started, len(request.reply))
+        request.future.set_result(self.dialog.decode([request.reply], True))
+
+
+# POST /chat 으로 메시지를 보내면 답변을, GET /stats 로 지연 시간과 처리량을 돌려주는 간단한 프론트엔드
+class ChatHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        if self.path != '/chat':
+            self.send_error(404)
+            return
+
+        msg = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+        try:
+            reply = self.server.chat.get_replay(msg.strip())
+        except Exception as e:
+            self.send_error(500, str(e))
+            return
+        self.respond(reply, 'text/plain; charset=utf-8')
+
+    def do_GET(self):
+        if self.path != '/stats':
+            self.send_error(404)
+            return
+
+        self.respond(json.dumps(self.server.chat.stats.snapshot()), 'application/json')
+
+    def respond(self, body, content_type):
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(chat, port):
+    httpd = ThreadingHTTPServer(('127.0.0.1', port), ChatHandler)
+    httpd.daemon_threads = True
+    httpd.chat = chat
+    return httpd
+
+
+# clients 명의 사용자가 동시에 대화 파일의 문장들을 나눠서 보낸다.
+def load_test(port, messages, clients):
+    url = 'http://127.0.0.1:%d/chat' % port
+
+    def client(lines):
+        for line in lines:
+            urllib.request.urlopen(url, line.encode('utf-8')).read()
+
+    threads = [threading.Thread(target=client, args=(messages[i::clients],)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def main(_):
+    print ("깨어나는 중 입니다. 잠시만 기다려주세요...\n")
+
+    chat = ChatServer(ChatBot(FLAGS.voc_path, FLAGS.train_dir),
+                      batch_wait=FLAGS.serve_batch_wait, max_batch=FLAGS.serve_max_batch).start()
+    httpd = serve(chat, FLAGS.serve_port)
+
+    if FLAGS.serve_clients > 0:
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+        with open(FLAGS.data_path, 'r', encoding="UTF8") as content_file:
+            messages = [line.strip() for line in content_file if line.strip()]
+
+        load_test(FLAGS.serve_port, messages, FLAGS.serve_clients)
+        print(json.dumps(chat.stats.snapshot(), indent=2))
+        httpd.shutdown()
+        chat.stop()
+    else:
+        print("http://127.0.0.1:%d/chat 으로 메시지를 보내세요. 통계: /stats" % FLAGS.serve_port)
+        httpd.serve_forever()
+
+if __name__ == "__main__":
+    tf.app.run()
@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 
 import tensorflow as tf
+import threading
 import random
+import queue
 import math
+import time
 import os
 
 from config import FLAGS
@@ -10,8 +13,48 @@ from model import Seq2Seq
 from dialog import Dialog
 
 
+# 학습 스텝이 도는 동안 다음 배치들을 백그라운드 스레드에서 미리 만들어 depth 개까지 큐에 쌓아둔다.
+# Dialog 의 배치 순서는 그대로이고, session.run 이 GIL 을 놓는 동안 패딩 작업이 겹쳐서 실행된다.
+class BatchPrefetcher:
+
+    def __init__(self, dialog, batch_size, depth):
+        self.dialog = dialog
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            while not self.stopped.is_set():
+                self.put(self.dialog.next_batch(self.batch_size))
+        except Exception as e:
+            # 배치를 만들다 난 에러는 학습 루프에서 다시 던진다.
+            self.put(e)
+
+    def put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def next_batch(self):
+        item = self.queue.get()
+        if isinstance(item, Exception):
+            raise item
+
+        return item
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
 def train(dialog, batch_size=100, epoch=100):
-    model = Seq2Seq(dialog.vocab_size)
+    model = Seq2Seq(dialog.vocab_size, num_sampled=FLAGS.num_sampled)
 
     with tf.Session() as sess:
 
@@ -34,18 +77,42 @@ def train(dialog, batch_size=100, epoch=100):
         # total step
         print(total_batch * epoch)
 
+        # 배치를 미리 만들어두는 입력 파이프라인
+        if FLAGS.prefetch > 0:
+            prefetcher = BatchPrefetcher(dialog, batch_size, FLAGS.prefetch)
+            next_batch = prefetcher.next_batch
+        else:
+            prefetcher = None
+            next_batch = lambda: dialog.next_batch(batch_size)
+
+        # 스텝 시간 중 배치를 기다린 시간과 학습에 쓴 시간
+        input_wait = 0.0
+        train_time = 0.0
+
         # 신경망 모델 학습
         for step in range(total_batch * epoch):
-            enc_input, dec_input, targets = dialog.next_batch(batch_size)
+            start = time.time()
+            enc_input, dec_input, targets = next_batch()
+            input_wait += time.time() - start
 
             # model 학습
+            start = time.time()
             _, loss = model.train(sess, enc_input, dec_input, targets)
+            train_time += time.time() - start
 
             # log 출력
             if (step + 1) % 100 == 0:
                 model.write_logs(sess, writer, enc_input, dec_input, targets)
                 print('Step:', '%06d' % model.global_step.eval(), \
-                      'cost =', '{:.6f}'.format(loss))
+                      'cost =', '{:.6f}'.format(loss), \
+                      'padding =', '{:.1%}'.format(dialog.padding_waste()), \
+                      'input_wait =', '{:.2f}ms'.format(input_wait * 1000 / 100), \
+                      'train =', '{:.2f}ms'.format(train_time * 1000 / 100))
+                input_wait = 0.0
+                train_time = 0.0
+
+        if prefetcher:
+            prefetcher.stop()
 
         checkpoint_path = os.path.join(FLAGS.train_dir, FLAGS.ckpt_name)
         model.saver.save(sess, checkpoint_path, global_step=model.global_step)
@@ -0,0 +1,319 @@
+# Binary store for the pretrained word embeddings (GloVe, fastText, paragram).
+#
+# The text files are parsed once by convert_embeddings() into a directory next to them:
+#   vectors.f32  float32 matrix, one row per word, in the order the original loaders saw them
+#   words.bin    utf-8 words joined together, with offsets.npy giving where each row's word starts
+#   keys.npy     64-bit hashes of the words, sorted, with rows.npy giving the matching row
+#   stats.json   rows, dim and the mean/std of all vectors (used for the random init of unknown words)
+# Later runs memory-map the store and only touch the rows needed for the vocabulary.
+
+import os
+import io
+import json
+import hashlib
+import multiprocessing
+import numpy as np
+
+STORE_SUFFIX = '.store'
+
+
+def word_key(word):
+    return int.from_bytes(hashlib.blake2b(word.encode('utf8'), digest_size=8).digest(), 'little')
+
+
+def parse_lines(lines, min_line_len=0):
+    # Same rules as get_coefs(*o.split(" ")) in the old loaders: the first field is the word and
+    # the rest are the vector. Lines not longer than min_line_len are skipped (fastText header).
+    words, vectors = [], []
+    for o in lines:
+        if len(o) <= min_line_len:
+            continue
+        word, *arr = o.split(" ")
+        words.append(word)
+        vectors.append(np.asarray(arr, dtype='float32'))
+    return words, vectors
+
+
+def read_chunk(path, start, end):
+    # the lines whose first byte falls in [start, end)
+    with open(path, 'rb') as f:
+        if start > 0:
+            f.seek(start - 1)
+            f.readline()
+        position = f.tell()
+        if position >= end:
+            return b''
+        data = f.read(end - position)
+        if not data.endswith(b'\n'):
+            data += f.readline()
+    return data
+
+
+def parse_chunk(args):
+    path, start, end, encoding, errors, min_line_len = args
+    # decoding the chunk the way open(path, encoding=..., errors=...) would gives the same lines,
+    # since chunks only break after a newline
+    text = io.TextIOWrapper(io.BytesIO(read_chunk(path, start, end)), encoding=encoding, errors=errors)
+    lines = [o for o in text if len(o) > min_line_len]
+    if not lines:
+        return [], None
+
+    # all the numbers of the chunk are converted by one np.fromstring call
+    words = [o.split(" ", 1)[0] for o in lines]
+    dim = lines[0].count(" ")
+    if all(o.count(" ") == dim for o in lines):
+        values = np.fromstring(" ".join([o[len(word) + 1:] for o, word in zip(lines, words)]),
+                               dtype=np.float32, sep=" ")
+        if values.size == len(lines) * dim:
+            return words, values.reshape(len(lines), dim)
+
+    # lines with empty or extra fields go through the old parser, which fails the same way the old loaders did
+    words, vectors = parse_lines(lines)
+    return words, np.stack(vectors)
+
+
+def chunk_ranges(embedding_file, processes, chunk_bytes):
+    size = os.path.getsize(embedding_file)
+    n_chunks = max(processes, size // chunk_bytes + 1)
+    bounds = [size * i // n_chunks for i in range(n_chunks + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def map_chunks(function, chunks, processes, initializer=None, initargs=()):
+    # results come back in file order
+    if processes > 1:
+        with multiprocessing.Pool(processes, initializer, initargs) as pool:
+            for result in pool.imap(function, chunks):
+                yield result
+    else:
+        if initializer:
+            initializer(*initargs)
+        for result in map(function, chunks):
+            yield result
+
+
+def convert_embeddings(embedding_file, store_dir=None, encoding=None, errors=None, min_line_len=0,
+                       processes=None, chunk_bytes=64 << 20):
+    store_dir = store_dir or embedding_file + STORE_SUFFIX
+    os.makedirs(store_dir, exist_ok=True)
+
+    # the file is split into byte ranges that are parsed in a process pool;
+    # rows are written to disk in file order and the word list is the only thing kept in memory
+    processes = processes or multiprocessing.cpu_count()
+    chunks = [(embedding_file, start, end, encoding, errors, min_line_len)
+              for start, end in chunk_ranges(embedding_file, processes, chunk_bytes)]
+
+    with open(os.path.join(store_dir, 'vectors.tmp'), 'wb') as out:
+        words, dim = write_chunks(map_chunks(parse_chunk, chunks, processes), out, embedding_file)
+
+    finish_store(store_dir, words, dim)
+    return store_dir
+
+
+def write_chunks(results, out, embedding_file):
+    words, dim = [], None
+    for chunk_words, chunk_vectors in results:
+        if chunk_vectors is not None:
+            dim = dim or chunk_vectors.shape[1]
+            if chunk_vectors.shape[1] != dim:
+                raise ValueError("vectors of different sizes in %s" % embedding_file)
+            chunk_vectors.tofile(out)
+        words.extend(chunk_words)
+    return words, dim
+
+
+def finish_store(store_dir, words, dim):
+    # dict(...) in the old loaders kept the first position and the last vector of a repeated word,
+    # so the same is done here before the stats are taken.
+    parsed = np.memmap(os.path.join(store_dir, 'vectors.tmp'), dtype=np.float32, mode='r',
+                       shape=(len(words), dim))
+    index = {}
+    for row, word in enumerate(words):
+        index[word] = row
+    rows = np.fromiter(index.values(), dtype=np.int64, count=len(index))
+
+    vectors_path = os.path.join(store_dir, 'vectors.f32')
+    if len(rows) == len(words):
+        del parsed
+        os.replace(os.path.join(store_dir, 'vectors.tmp'), vectors_path)
+    else:
+        vectors = np.memmap(vectors_path, dtype=np.float32, mode='w+', shape=(len(rows), dim))
+        for start in range(0, len(rows), 100000):
+            vectors[start:start + 100000] = parsed[rows[start:start + 100000]]
+        vectors.flush()
+        del vectors, parsed
+        os.remove(os.path.join(store_dir, 'vectors.tmp'))
+    words = list(index)
+
+    encoded = [word.encode('utf8') for word in words]
+    with open(os.path.join(store_dir, 'words.bin'), 'wb') as f:
+        f.write(b''.join(encoded))
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(word) for word in encoded], out=offsets[1:])
+    np.save(os.path.join(store_dir, 'offsets.npy'), offsets)
+
+    keys = np.fromiter((word_key(word) for word in words), dtype=np.uint64, count=len(words))
+    order = np.argsort(keys, kind='stable')
+    np.save(os.path.join(store_dir, 'keys.npy'), keys[order])
+    np.save(os.path.join(store_dir, 'rows.npy'), order)
+
+    # np.stack(embeddings_index.values()).mean()/.std() over the same array gives the same numbers
+    vectors = np.memmap(vectors_path, dtype=np.float32, mode='r', shape=(len(words), dim))
+    stats = {'rows': len(words), 'dim': dim, 'mean': float(vectors.mean()), 'std': float(vectors.std())}
+    with open(os.path.join(store_dir, 'stats.json'), 'w') as f:
+        json.dump(stats, f)
+
+
+class EmbeddingStore(object):
+    def __init__(self, store_dir):
+        with open(os.path.join(store_dir, 'stats.json')) as f:
+            stats = json.load(f)
+        self.rows = stats['rows']
+        self.dim = stats['dim']
+        self.mean = np.float32(stats['mean'])
+        self.std = np.float32(stats['std'])
+
+        self.vectors = np.memmap(os.path.join(store_dir, 'vectors.f32'), dtype=np.float32, mode='r',
+                                 shape=(self.rows, self.dim))
+        self.words = np.memmap(os.path.join(store_dir, 'words.bin'), dtype=np.uint8, mode='r')
+        self.offsets = np.load(os.path.join(store_dir, 'offsets.npy'), mmap_mode='r')
+        self.keys = np.load(os.path.join(store_dir, 'keys.npy'), mmap_mode='r')
+        self.key_rows = np.load(os.path.join(store_dir, 'rows.npy'), mmap_mode='r')
+
+    def word(self, row):
+        return self.words[self.offsets[row]:self.offsets[row + 1]].tobytes().decode('utf8')
+
+    def lookup(self, words):
+        # row of each word in the store, -1 if it is missing
+        keys = np.fromiter((word_key(word) for word in words), dtype=np.uint64, count=len(words))
+        positions = np.searchsorted(self.keys, keys)
+        found = np.full(len(words), -1, dtype=np.int64)
+        for i, (word, key, position) in enumerate(zip(words, keys, positions)):
+            while position < len(self.keys) and self.keys[position] == key:
+                row = self.key_rows[position]
+                if self.word(row) == word:
+                    found[i] = row
+                    break
+                position += 1
+        return found
+
+
+class FilteredEmbeddings(object):
+    # the rows of a text file that matched a vocabulary, with the stats of the whole file
+    def __init__(self, words, vectors, mean, std):
+        self.index = {word: row for row, word in enumerate(words)}
+        self.vectors = vectors
+        self.rows, self.dim = vectors.shape
+        self.mean = mean
+        self.std = std
+
+    def lookup(self, words):
+        return np.array([self.index.get(word, -1) for word in words], dtype=np.int64)
+
+
+_wanted = None
+
+
+def set_wanted(words):
+    global _wanted
+    _wanted = words
+
+
+def scan_chunk(args):
+    # keeps the rows of the wanted words; for the mean/std every row is reduced to its key, sum and sum of squares
+    words, vectors = parse_chunk(args)
+    if vectors is None:
+        return [], None, None, None, None
+    keep = [row for row, word in enumerate(words) if word in _wanted]
+    keys = np.fromiter((word_key(word) for word in words), dtype=np.uint64, count=len(words))
+    return ([words[row] for row in keep], vectors[keep], keys,
+            vectors.sum(axis=1, dtype=np.float64), np.square(vectors, dtype=np.float64).sum(axis=1))
+
+
+def scan_embeddings(embedding_file, words, encoding=None, errors=None, min_line_len=0,
+                    processes=None, chunk_bytes=64 << 20):
+    # Reads only the rows of the given words from a text file, in a process pool. Nothing is written to
+    # disk, and besides the kept rows only 24 bytes per line are held for the mean/std. Those are summed
+    # in float64, so they can differ from the float32 np.stack(...).mean() of the old loaders in the last bits.
+    processes = processes or multiprocessing.cpu_count()
+    chunks = [(embedding_file, start, end, encoding, errors, min_line_len)
+              for start, end in chunk_ranges(embedding_file, processes, chunk_bytes)]
+
+    index, parts, keys, sums, squares, dim = {}, [], [], [], [], None
+    results = map_chunks(scan_chunk, chunks, processes, set_wanted, (set(words),))
+    for chunk_words, chunk_vectors, chunk_keys, chunk_sums, chunk_squares in results:
+        if chunk_vectors is None:
+            continue
+        dim = dim or chunk_vectors.shape[1]
+        if chunk_vectors.shape[1] != dim:
+            raise ValueError("vectors of different sizes in %s" % embedding_file)
+        offset = sum(len(part) for part in parts)
+        for row, word in enumerate(chunk_words):
+            index[word] = offset + row  # a repeated word keeps its last vector, like dict(...)
+        parts.append(chunk_vectors)
+        keys.append(chunk_keys)
+        sums.append(chunk_sums)
+        squares.append(chunk_squares)
+
+    if not parts:
+        raise ValueError("no vectors in %s" % embedding_file)
+    vectors = np.concatenate(parts)
+
+    # the stats only count the last line of a repeated word, like np.stack(embeddings_index.values())
+    keys = np.concatenate(keys)
+    _, last = np.unique(keys[::-1], return_index=True)
+    last = len(keys) - 1 - last
+    size = len(last) * dim
+    mean = np.concatenate(sums)[last].sum() / size
+    std = np.sqrt(max(np.concatenate(squares)[last].sum() / size - mean * mean, 0.0))
+    return FilteredEmbeddings(list(index), vectors[list(index.values())], np.float32(mean), np.float32(std))
+
+
+def case_variants(word):
+    return [word.lower(), word.title()]
+
+
+def vocab_words(word_index, max_features):
+    return [word for word, i in word_index.items() if i < max_features]
+
+
+def open_embeddings(embedding_file, encoding=None, errors=None, min_line_len=0, words=None, case_fallback=False):
+    # Uses the binary store when there is one. Otherwise the text file is converted to a store, or, when
+    # the vocabulary is given, scanned for just those words (and their case variants with case_fallback).
+    store_dir = embedding_file + STORE_SUFFIX
+    if os.path.exists(os.path.join(store_dir, 'stats.json')):
+        return EmbeddingStore(store_dir)
+    if words is not None:
+        wanted = set(words)
+        if case_fallback:
+            wanted.update(variant for word in words for variant in case_variants(word))
+        print("scanning", embedding_file, "for", len(wanted), "words")
+        return scan_embeddings(embedding_file, wanted, encoding, errors, min_line_len)
+    print("converting", embedding_file)
+    convert_embeddings(embedding_file, store_dir, encoding, errors, min_line_len)
+    return EmbeddingStore(store_dir)
+
+
+def build_embedding_matrix(store, word_index, max_features, case_fallback=False):
+    # same matrix as the old loaders: N(mean, std) for unknown words, the stored vector otherwise.
+    # With case_fallback a word that is missing is looked up again lowercased, then title-cased.
+    nb_words = min(max_features, len(word_index))
+    embedding_matrix = np.random.normal(store.mean, store.std, (nb_words, store.dim))
+    words = vocab_words(word_index, max_features)
+    ids = np.array([word_index[word] for word in words], dtype=np.int64)
+    rows = store.lookup(words)
+
+    found = [('exact', int((rows >= 0).sum()))]
+    if case_fallback:
+        for name, variant in zip(('lower', 'title'), zip(*[case_variants(word) for word in words])):
+            missing = np.flatnonzero(rows < 0)
+            rows[missing] = store.lookup([variant[i] for i in missing])
+            found.append((name, int((rows[missing] >= 0).sum())))
+    print("embedding coverage: {:.2%} of {} words ({})".format(
+        (rows >= 0).mean() if len(rows) else 0.0, len(words), ', '.join('%s %d' % item for item in found)))
+
+    hit = rows >= 0
+    # sorting the rows keeps the reads from the memory map sequential
+    order = np.argsort(rows[hit])
+    embedding_matrix[ids[hit][order]] = store.vectors[rows[hit][order]]
+    return embedding_matrix
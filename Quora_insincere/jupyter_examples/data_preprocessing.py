@@ -1,19 +1,37 @@
 import os
+import sys
 import pandas as pd
 import numpy as np
 import re
 import json
+import time
+
+from multiprocessing import Pool, cpu_count
 
 from tensorflow.python.keras.preprocessing.text import Tokenizer
 from tensorflow.python.keras.preprocessing.sequence import pad_sequences
 from sklearn.model_selection import train_test_split
 
+# embeddings.py and prep_cache.py are shared with ../lstm.py
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from embeddings import open_embeddings, build_embedding_matrix, vocab_words
+from prep_cache import PrepCache, source_of
+
 ## some config values 
 embed_size = 300 # how big is each word vector
 max_features = 95000 # how many unique words to use (i.e num rows in embedding vector)
 maxlen = 70 # max number of words in a question to use
+embedding_store = True # convert each embedding file to a binary store once; False only scans the text for the vocabulary
+case_fallback = False # look up words missing from the embeddings again lowercased, then title-cased
+clean_processes = 1 # processes used to clean the question text
 
 DATA_DIR = '../input/'
+TRAIN_CSV = DATA_DIR + 'train.csv'
+TEST_CSV = DATA_DIR + 'test.csv'
+GLOVE_FILE = DATA_DIR + 'embeddings/glove.840B.300d/glove.840B.300d.txt'
+FASTTEXT_FILE = DATA_DIR + 'embeddings/wiki-news-300d-1M/wiki-news-300d-1M.vec'
+PARA_FILE = DATA_DIR + 'embeddings/paragram_300_sl999/paragram_300_sl999.txt'
+CACHE_DIR = DATA_DIR + 'cache' # preprocessed arrays and embedding matrices, see prep_cache.py
 TRAIN_DATA = 'train.npy'
 TRAIN_LEN_DATA = 'train_len.npy'
 TEST_DATA = 'test.npy'
@@ -45,7 +63,14 @@ puncts = [',', '.', '"', ':', ')', '(', '-', '!', '?', '|', ';', "'", '$', '&',
 
 stop_words = ['me', 'my', 'myself', 'we', 'our', 'ours', 'ourselves', 'you', "you're", "you've", "you'll", "you'd", 'your', 'yours', 'yourself', 'yourselves', 'he', 'him', 'his', 'himself', 'she', "she's", 'her', 'hers', 'herself', 'it', "it's", 'its', 'itself', 'they', 'them', 'their', 'theirs', 'themselves', 'what', 'which', 'who', 'whom', 'this', 'that', "that'll", 'these', 'those', 'am', 'is', 'are', 'was', 'were', 'be', 'been', 'being', 'have', 'has', 'had', 'having', 'do', 'does', 'did', 'doing', 'a', 'an', 'the', 'and', 'but', 'if', 'or', 'because', 'as', 'until', 'while', 'of', 'at', 'by', 'for', 'with', 'about', 'against', 'between', 'into', 'through', 'during', 'before', 'after', 'above', 'below', 'to', 'from', 'up', 'down', 'in', 'out', 'on', 'off', 'over', 'under', 'again', 'further', 'then', 'once', 'here', 'there', 'when', 'where', 'why', 'how', 'all', 'any', 'both', 'each', 'few', 'more', 'most', 'other', 'some', 'such', 'no', 'nor', 'not', 'only', 'own', 'same', 'so', 'than', 'too', 'very', 's', 't', 'can', 'will', 'just', 'don', "don't", 'should', "should've", 'now', 'd', 'll', 'm', 'o', 're', 've', 'y', 'ain', 'aren', "aren't", 'couldn', "couldn't", 'didn', "didn't", 'doesn', "doesn't", 'hadn', "hadn't", 'hasn', "hasn't", 'haven', "haven't",  'isn', "isn't", 'ma', 'mightn', "mightn't", 'mustn', "mustn't", 'needn', "needn't", 'shan', "shan't", 'shouldn', "shouldn't", 'wasn', "wasn't", 'weren', "weren't", 'won', "won't", 'wouldn', "wouldn't"]
 
+# every punct is a single character, so one str.translate pass gives exactly the text of the replace loop below
+punct_table = str.maketrans({punct: f' {punct} ' for punct in puncts})
+
 def clean_text(x):
+    return str(x).translate(punct_table)
+
+# the original cleaning loop, kept as the reference for benchmark_clean_text
+def clean_text_loop(x):
     x = str(x)
 
     # for stop in stop_words:
@@ -57,13 +82,33 @@ def clean_text(x):
         
     return x
 
+# clean a whole column at once; with processes > 1 the questions are split over a process pool
+def clean_texts(texts, processes=1):
+    if processes > 1:
+        with Pool(processes) as pool:
+            return pool.map(clean_text, texts, chunksize=10000)
+    return [clean_text(x) for x in texts]
+
+def benchmark_clean_text(path=TRAIN_CSV):
+    texts = pd.read_csv(path)["question_text"].str.lower().tolist()
+
+    start = time.time()
+    expected = [clean_text_loop(x) for x in texts]
+    print("replace loop : {:.2f}s".format(time.time() - start))
+
+    for processes in sorted({1, cpu_count()}):
+        start = time.time()
+        cleaned = clean_texts(texts, processes)
+        print("translate, {} process(es) : {:.2f}s".format(processes, time.time() - start))
+        assert cleaned == expected
+
 def split_text(x):
     x = wordninja.split(x)
     return '-'.join(x)
 
 def load_and_prec():
-    train_df = pd.read_csv("../input/train.csv")
-    test_df = pd.read_csv("../input/test.csv")
+    train_df = pd.read_csv(TRAIN_CSV)
+    test_df = pd.read_csv(TEST_CSV)
 
     # train_df = train_df[:100]
     # test_df = test_df[:100]
@@ -71,8 +116,8 @@ def load_and_prec():
     train_df["question_text"] = train_df["question_text"].str.lower()
     test_df["question_text"] = test_df["question_text"].str.lower()
     
-    train_df["question_text"] = train_df["question_text"].apply(lambda x: clean_text(x))
-    test_df["question_text"] = test_df["question_text"].apply(lambda x: clean_text(x))
+    train_df["question_text"] = clean_texts(train_df["question_text"], clean_processes)
+    test_df["question_text"] = clean_texts(test_df["question_text"], clean_processes)
     
     print("Train shape : ",train_df.shape)
     print("Test shape : ",test_df.shape)
@@ -117,106 +162,70 @@ def load_and_prec():
     return train_X, test_X, train_y, tokenizer.word_index, train_X_len, test_X_len
 
 def load_glove(word_index):
-    EMBEDDING_FILE = '../input/embeddings/glove.840B.300d/glove.840B.300d.txt'
-    def get_coefs(word,*arr): return word, np.asarray(arr, dtype='float32')
-    embeddings_index = dict(get_coefs(*o.split(" ")) for o in open(EMBEDDING_FILE))
-
-    all_embs = np.stack(embeddings_index.values())
-    emb_mean,emb_std = all_embs.mean(), all_embs.std()
-    embed_size = all_embs.shape[1]
-
-    # word_index = tokenizer.word_index
-    nb_words = min(max_features, len(word_index))
-    embedding_matrix = np.random.normal(emb_mean, emb_std, (nb_words, embed_size))
-    for word, i in word_index.items():
-        if i >= max_features: continue
-        embedding_vector = embeddings_index.get(word)
-        if embedding_vector is not None: embedding_matrix[i] = embedding_vector
-            
-    return embedding_matrix 
+    EMBEDDING_FILE = GLOVE_FILE
+    words = None if embedding_store else vocab_words(word_index, max_features)
+    store = open_embeddings(EMBEDDING_FILE, words=words, case_fallback=case_fallback)
+    return build_embedding_matrix(store, word_index, max_features, case_fallback)
     
 def load_fasttext(word_index):    
-    EMBEDDING_FILE = '../input/embeddings/wiki-news-300d-1M/wiki-news-300d-1M.vec'
-    def get_coefs(word,*arr): return word, np.asarray(arr, dtype='float32')
-    embeddings_index = dict(get_coefs(*o.split(" ")) for o in open(EMBEDDING_FILE) if len(o)>100)
-
-    all_embs = np.stack(embeddings_index.values())
-    emb_mean,emb_std = all_embs.mean(), all_embs.std()
-    embed_size = all_embs.shape[1]
-
-    # word_index = tokenizer.word_index
-    nb_words = min(max_features, len(word_index))
-    embedding_matrix = np.random.normal(emb_mean, emb_std, (nb_words, embed_size))
-    for word, i in word_index.items():
-        if i >= max_features: continue
-        embedding_vector = embeddings_index.get(word)
-        if embedding_vector is not None: embedding_matrix[i] = embedding_vector
-
-    return embedding_matrix
+    EMBEDDING_FILE = FASTTEXT_FILE
+    words = None if embedding_store else vocab_words(word_index, max_features)
+    store = open_embeddings(EMBEDDING_FILE, min_line_len=100, words=words, case_fallback=case_fallback)
+    return build_embedding_matrix(store, word_index, max_features, case_fallback)
 
 def load_para(word_index):
-    EMBEDDING_FILE = '../input/embeddings/paragram_300_sl999/paragram_300_sl999.txt'
-    def get_coefs(word,*arr): return word, np.asarray(arr, dtype='float32')
-    embeddings_index = dict(get_coefs(*o.split(" ")) for o in open(EMBEDDING_FILE, encoding="utf8", errors='ignore') if len(o)>100)
-
-    all_embs = np.stack(embeddings_index.values())
-    emb_mean,emb_std = all_embs.mean(), all_embs.std()
-    embed_size = all_embs.shape[1]
-
-    # word_index = tokenizer.word_index
-    nb_words = min(max_features, len(word_index))
-    embedding_matrix = np.random.normal(emb_mean, emb_std, (nb_words, embed_size))
-    for word, i in word_index.items():
-        if i >= max_features: continue
-        embedding_vector = embeddings_index.get(word)
-        if embedding_vector is not None: embedding_matrix[i] = embedding_vector
-    
-    return embedding_matrix
+    EMBEDDING_FILE = PARA_FILE
+    words = None if embedding_store else vocab_words(word_index, max_features)
+    store = open_embeddings(EMBEDDING_FILE, encoding="utf8", errors='ignore', min_line_len=100, words=words, case_fallback=case_fallback)
+    return build_embedding_matrix(store, word_index, max_features, case_fallback)
 
 if __name__ == '__main__':
+
+    # python data_preprocessing.py bench_clean
+    if sys.argv[1:] == ['bench_clean']:
+        benchmark_clean_text()
+        sys.exit()
     
     # For loading train & test dataset
-    if os.path.exists(DATA_DIR + TRAIN_DATA):
-        print("test data exists")
-        input_data = np.load(open(DATA_DIR + TRAIN_DATA, 'rb'))
-        label_data = np.load(open(DATA_DIR + TRAIN_LABEL_DATA, 'rb'))
-        data_configs = json.load(open(DATA_DIR + DATA_CONFIGS, 'r'))
-        word_vocab = data_configs['vocab']
-    else:
-        print("no preprocessing file exists")
-        train_X, test_X, train_y, word_index, train_X_len, test_X_len = load_and_prec()
-        # train_X, val_X, test_X, train_y, val_y, word_index = load_and_prec()
-        # vocab = []
-        # for w,k in word_index.items():
-        #     vocab.append(w)
-        #     if k >= max_features:
-        #         break
-
-        # train_X, val_X, test_X, train_y, val_y, word_index = load_and_prec()
-            
-        data_configs = {}
-        data_configs['vocab'] = word_index
-        data_configs['vocab_size'] = len(word_index) + 1
-
-        json.dump(data_configs, open(DATA_DIR + DATA_CONFIGS, 'w'))
-        np.save(open(DATA_DIR + TEST_DATA, 'wb'), test_X)
-        np.save(open(DATA_DIR + TEST_LEN_DATA, 'wb'), test_X_len)
-
-        #save train and test dataset into numpy
-        np.save(open(DATA_DIR + TRAIN_DATA, 'wb'), train_X)
-        np.save(open(DATA_DIR + TRAIN_LEN_DATA, 'wb'), train_X_len)
-        np.save(open(DATA_DIR + TRAIN_LABEL_DATA , 'wb'), train_y)
+    # the cache is keyed by the csv contents and everything that changes the result, including the cleaning rules,
+    # so the files below are always written from arrays that match the current inputs
+    cache = PrepCache(CACHE_DIR, [TRAIN_CSV, TEST_CSV], max_features=max_features, maxlen=maxlen, puncts=puncts,
+                      code=source_of(load_and_prec, clean_text, clean_texts))
+    train_X, test_X, train_y, word_index, train_X_len, test_X_len = cache.data(
+        ('train_X', 'test_X', 'train_y', 'vocab', 'train_X_len', 'test_X_len'), load_and_prec)
+    embedding_params = dict(case_fallback=case_fallback, embedding_store=embedding_store)
+    # train_X, val_X, test_X, train_y, val_y, word_index = load_and_prec()
+    # vocab = []
+    # for w,k in word_index.items():
+    #     vocab.append(w)
+    #     if k >= max_features:
+    #         break
+
+    # train_X, val_X, test_X, train_y, val_y, word_index = load_and_prec()
+        
+    data_configs = {}
+    data_configs['vocab'] = word_index
+    data_configs['vocab_size'] = len(word_index) + 1
+
+    json.dump(data_configs, open(DATA_DIR + DATA_CONFIGS, 'w'))
+    np.save(open(DATA_DIR + TEST_DATA, 'wb'), test_X)
+    np.save(open(DATA_DIR + TEST_LEN_DATA, 'wb'), test_X_len)
+
+    #save train and test dataset into numpy
+    np.save(open(DATA_DIR + TRAIN_DATA, 'wb'), train_X)
+    np.save(open(DATA_DIR + TRAIN_LEN_DATA, 'wb'), train_X_len)
+    np.save(open(DATA_DIR + TRAIN_LABEL_DATA , 'wb'), train_y)
 
     print("save glove embedding")
-    embedding_matrix_1 = load_glove(word_index)
+    embedding_matrix_1 = cache.matrix('glove', GLOVE_FILE, load_glove, word_index, **embedding_params)
     np.save(open(DATA_DIR + 'glove.npy', 'wb'), embedding_matrix_1)
     
     print("save fasttext embedding")
-    embedding_matrix_2 = load_fasttext(word_index)
+    embedding_matrix_2 = cache.matrix('fasttext', FASTTEXT_FILE, load_fasttext, word_index, **embedding_params)
     np.save(open(DATA_DIR + 'fasttext.npy', 'wb'), embedding_matrix_2)
     
     print("save para embedding")
-    embedding_matrix_3 = load_para(word_index)
+    embedding_matrix_3 = cache.matrix('para', PARA_FILE, load_para, word_index, **embedding_params)
     np.save(open(DATA_DIR + 'para.npy', 'wb'), embedding_matrix_3)
     
     # np.save(open(DATA_DIR + 'glove.npy', 'wb'), embedding_matrix_1)
@@ -40,16 +40,28 @@ from tensorflow.keras import initializers, regularizers, constraints, optimizers
 from tensorflow.keras.layers import concatenate
 from tensorflow.keras.callbacks import *
 
+from embeddings import open_embeddings, build_embedding_matrix, vocab_words
+from prep_cache import PrepCache, source_of
+
 os.environ["CUDA_VISIBLE_DEVICES"]="7"
 
 ## some config values 
 embed_size = 300 # how big is each word vector
 max_features = 95000 # how many unique words to use (i.e num rows in embedding vector)
 maxlen = 70 # max number of words in a question to use
+embedding_store = True # convert each embedding file to a binary store once; False only scans the text for the vocabulary
+case_fallback = False # look up words missing from the embeddings again lowercased, then title-cased
+
+TRAIN_CSV = './data_in/train.csv'
+TEST_CSV = './data_in/test.csv'
+GLOVE_FILE = './data_in/embeddings/glove.840B.300d/glove.840B.300d.txt'
+FASTTEXT_FILE = './data_in/embeddings/wiki-news-300d-1M/wiki-news-300d-1M.vec'
+PARA_FILE = './data_in/embeddings/paragram_300_sl999/paragram_300_sl999.txt'
+CACHE_DIR = './data_in/cache' # preprocessed arrays and embedding matrices, see prep_cache.py
 
 def load_and_prec():
-    train_df = pd.read_csv("./data_in/train.csv")
-    test_df = pd.read_csv("./data_in/test.csv")
+    train_df = pd.read_csv(TRAIN_CSV)
+    test_df = pd.read_csv(TEST_CSV)
     print("Train shape : ",train_df.shape)
     print("Test shape : ",test_df.shape)
     
@@ -80,61 +92,22 @@ def load_and_prec():
     return train_X, test_X, train_y, tokenizer.word_index
 
 def load_glove(word_index):
-    EMBEDDING_FILE = './data_in/embeddings/glove.840B.300d/glove.840B.300d.txt'
-    def get_coefs(word,*arr): return word, np.asarray(arr, dtype='float32')
-    embeddings_index = dict(get_coefs(*o.split(" ")) for o in open(EMBEDDING_FILE))
-
-    all_embs = np.stack(embeddings_index.values())
-    emb_mean,emb_std = all_embs.mean(), all_embs.std()
-    embed_size = all_embs.shape[1]
-
-    # word_index = tokenizer.word_index
-    nb_words = min(max_features, len(word_index))
-    embedding_matrix = np.random.normal(emb_mean, emb_std, (nb_words, embed_size))
-    for word, i in word_index.items():
-        if i >= max_features: continue
-        embedding_vector = embeddings_index.get(word)
-        if embedding_vector is not None: embedding_matrix[i] = embedding_vector
-            
-    return embedding_matrix 
+    EMBEDDING_FILE = GLOVE_FILE
+    words = None if embedding_store else vocab_words(word_index, max_features)
+    store = open_embeddings(EMBEDDING_FILE, words=words, case_fallback=case_fallback)
+    return build_embedding_matrix(store, word_index, max_features, case_fallback)
     
 def load_fasttext(word_index):    
-    EMBEDDING_FILE = './data_in/embeddings/wiki-news-300d-1M/wiki-news-300d-1M.vec'
-    def get_coefs(word,*arr): return word, np.asarray(arr, dtype='float32')
-    embeddings_index = dict(get_coefs(*o.split(" ")) for o in open(EMBEDDING_FILE) if len(o)>100)
-
-    all_embs = np.stack(embeddings_index.values())
-    emb_mean,emb_std = all_embs.mean(), all_embs.std()
-    embed_size = all_embs.shape[1]
-
-    # word_index = tokenizer.word_index
-    nb_words = min(max_features, len(word_index))
-    embedding_matrix = np.random.normal(emb_mean, emb_std, (nb_words, embed_size))
-    for word, i in word_index.items():
-        if i >= max_features: continue
-        embedding_vector = embeddings_index.get(word)
-        if embedding_vector is not None: embedding_matrix[i] = embedding_vector
-
-    return embedding_matrix
+    EMBEDDING_FILE = FASTTEXT_FILE
+    words = None if embedding_store else vocab_words(word_index, max_features)
+    store = open_embeddings(EMBEDDING_FILE, min_line_len=100, words=words, case_fallback=case_fallback)
+    return build_embedding_matrix(store, word_index, max_features, case_fallback)
 
 def load_para(word_index):
-    EMBEDDING_FILE = './data_in/embeddings/paragram_300_sl999/paragram_300_sl999.txt'
-    def get_coefs(word,*arr): return word, np.asarray(arr, dtype='float32')
-    embeddings_index = dict(get_coefs(*o.split(" ")) for o in open(EMBEDDING_FILE, encoding="utf8", errors='ignore') if len(o)>100)
-
-    all_embs = np.stack(embeddings_index.values())
-    emb_mean,emb_std = all_embs.mean(), all_embs.std()
-    embed_size = all_embs.shape[1]
-
-    # word_index = tokenizer.word_index
-    nb_words = min(max_features, len(word_index))
-    embedding_matrix = np.random.normal(emb_mean, emb_std, (nb_words, embed_size))
-    for word, i in word_index.items():
-        if i >= max_features: continue
-        embedding_vector = embeddings_index.get(word)
-        if embedding_vector is not None: embedding_matrix[i] = embedding_vector
-    
-    return embedding_matrix
+    EMBEDDING_FILE = PARA_FILE
+    words = None if embedding_store else vocab_words(word_index, max_features)
+    store = open_embeddings(EMBEDDING_FILE, encoding="utf8", errors='ignore', min_line_len=100, words=words, case_fallback=case_fallback)
+    return build_embedding_matrix(store, word_index, max_features, case_fallback)
 
 
 
@@ -417,10 +390,14 @@ def train_pred(model, train_X, train_y, val_X, val_y, epochs=2, callback=None):
     print('=' * 60)
     return pred_val_y, pred_test_y, best_score
 
-train_X, test_X, train_y, word_index = load_and_prec()
-embedding_matrix_1 = load_glove(word_index)
-# embedding_matrix_2 = load_fasttext(word_index)
-embedding_matrix_3 = load_para(word_index)
+# reruns with the same csv files and parameters skip the tokenization and embedding work
+cache = PrepCache(CACHE_DIR, [TRAIN_CSV, TEST_CSV], max_features=max_features, maxlen=maxlen,
+                  code=source_of(load_and_prec))
+train_X, test_X, train_y, word_index = cache.data(('train_X', 'test_X', 'train_y', 'vocab'), load_and_prec)
+embedding_params = dict(case_fallback=case_fallback, embedding_store=embedding_store)
+embedding_matrix_1 = cache.matrix('glove', GLOVE_FILE, load_glove, word_index, **embedding_params)
+# embedding_matrix_2 = cache.matrix('fasttext', FASTTEXT_FILE, load_fasttext, word_index, **embedding_params)
+embedding_matrix_3 = cache.matrix('para', PARA_FILE, load_para, word_index, **embedding_params)
 
 ## Simple average: http://aclweb.org/anthology/N18-2031
 
@@ -0,0 +1,107 @@
+# Content-addressed cache for the preprocessed Quora data, shared by lstm.py and jupyter_examples/data_preprocessing.py.
+#
+# An entry is a directory named after a hash of the contents of the input csv files and of the preprocessing
+# parameters (max_features, maxlen, the cleaning rules, the source of the preprocessing functions), so changing
+# any of them makes a new entry instead of reusing stale arrays:
+#   entry.json         the parameters and the names of the saved arrays
+#   <name>.npy         padded sequences, lengths and labels
+#   vocab.json         the tokenizer word_index
+#   <name>-<key>.npy   embedding matrices, keyed again by the size/mtime of the embedding file, the contents of
+#                      embeddings.py (parsing and matrix building), the source of the function that calls it, its
+#                      parameters and the seed
+# Everything is written under a temporary name first and renamed into place, so an interrupted run never
+# leaves a half-written entry behind.
+
+import os
+import json
+import shutil
+import hashlib
+import inspect
+import numpy as np
+
+import embeddings
+
+
+def file_digest(path, block_size=1 << 20):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def source_of(*functions):
+    # falls back to the bytecode when the source file is not available
+    sources = []
+    for function in functions:
+        try:
+            sources.append(inspect.getsource(function))
+        except (OSError, TypeError):
+            sources.append(function.__code__.co_code.hex())
+    return ''.join(sources)
+
+
+class PrepCache(object):
+    def __init__(self, cache_dir, inputs, seed=2018, **params):
+        key = hashlib.blake2b(digest_size=16)
+        for path in inputs:
+            key.update(file_digest(path).encode('utf8'))
+        key.update(json.dumps(params, sort_keys=True).encode('utf8'))
+        self.params = params
+        self.seed = seed
+        self.dir = os.path.join(cache_dir, key.hexdigest())
+
+    def data(self, names, function, *args):
+        # returns the values of function(*args), named by names, from the cache or by running it once.
+        # The value named 'vocab' is the word_index dict, everything else is a numpy array.
+        entry_path = os.path.join(self.dir, 'entry.json')
+        if os.path.exists(entry_path):
+            print("preprocessed data found in", self.dir)
+            return [self.load(name) for name in names]
+
+        print("no preprocessing file exists")
+        values = function(*args)
+        tmp_dir = self.dir + '.tmp%d' % os.getpid()
+        os.makedirs(tmp_dir, exist_ok=True)
+        for name, value in zip(names, values):
+            if name == 'vocab':
+                with open(os.path.join(tmp_dir, 'vocab.json'), 'w') as f:
+                    json.dump(value, f)
+            else:
+                np.save(os.path.join(tmp_dir, name + '.npy'), value)
+        with open(os.path.join(tmp_dir, 'entry.json'), 'w') as f:
+            json.dump({'params': self.params, 'names': list(names)}, f)
+
+        if os.path.exists(self.dir):
+            # another run saved the same entry first
+            shutil.rmtree(tmp_dir)
+        else:
+            os.rename(tmp_dir, self.dir)
+        return values
+
+    def load(self, name):
+        if name == 'vocab':
+            with open(os.path.join(self.dir, 'vocab.json')) as f:
+                return json.load(f)
+        return np.load(os.path.join(self.dir, name + '.npy'))
+
+    def matrix(self, name, embedding_file, function, *args, **params):
+        # the embedding files are several GB, so they are keyed by size and mtime instead of their contents.
+        # Call this after data(): the matrix belongs to the entry of the vocabulary it was built for.
+        # np.random is seeded first, so the random rows of unknown words do not depend on whether data() ran
+        # the preprocessing or what else drew from np.random before.
+        stat = os.stat(embedding_file)
+        key = json.dumps([stat.st_size, stat.st_mtime_ns, self.seed, file_digest(embeddings.__file__),
+                          source_of(function), params], sort_keys=True)
+        key = hashlib.blake2b(key.encode('utf8'), digest_size=8).hexdigest()
+        path = os.path.join(self.dir, '%s-%s.npy' % (name, key))
+        if os.path.exists(path):
+            print("cached", name, "embedding matrix")
+            return np.load(path)
+
+        np.random.seed(self.seed)
+        embedding_matrix = function(*args)
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, embedding_matrix)
+        os.replace(path + '.tmp', path)
+        return embedding_matrix